@@ -0,0 +1,367 @@
+"""
+Benchmarks of the lattice sums of tutorial/calc_limit.py and hw05 against
+value_range, run from the repository root:
+
+    python -m benchmarks.bench_lattice_sums --label baseline
+    python -m benchmarks.bench_lattice_sums --label new --compare baseline
+
+Every case runs in a fresh process, so its peak RSS is its own, and
+with the lattice-sum cache off.
+Results go to benchmarks/results/<label>.json.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+from datetime import datetime, timezone
+from importlib import import_module
+from queue import Empty
+
+import numpy as np
+
+from utils.cache_utils import set_cache_enabled
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+RESULTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'results',
+)
+DEFAULT_VALUE_RANGES = (10, 30, 100, 300, 1000)
+# (2*1000+1)^3 = 8e9 points of a 3D sum take minutes, skip by default
+DEFAULT_MAX_POINTS = 3*10**8
+# seconds a case may run before it is stopped and recorded as failed
+DEFAULT_TIMEOUT = 3600
+
+# converged values: Ewald for the 2D Madelung sums, the Richardson
+# extrapolated sums at value_range 100 (3D) or 300 (2D) for the others,
+# which agree with value_range 150 or 400 to a few 1e-16
+CASES = {
+    'calc_limit_cubic': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(power=[6, 3]),
+        dim=3,
+        reference=[6.202149045047516, 8.401923974827545],
+    ),
+    'calc_limit_FCC': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(power=[6, 3]),
+        dim=3,
+        reference=[776.440332578853, 115.6313683499558],
+    ),
+    'calc_limit_NaCl': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(power=[6, 3]),
+        dim=3,
+        reference=[24627.56215593578, 422.0917660390067],
+    ),
+    # the direct sum over cubes of primitive cells converges to a shape
+    # dependent value and not to the Ewald one (-3.4951291892663647).
+    # Its limit, as 1/value_range^2, extrapolated from value_range 200
+    # and 400, which agrees with 100 and 200 to 1e-7
+    'calc_Madelung_NaCl': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(),
+        dim=3,
+        reference=0.3430798711626166,
+    ),
+    # the 2D direct sums converge to the Ewald value, as 1/value_range
+    'calc_Madelung_KCl_2D': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(),
+        dim=2,
+        reference=-2.284722293289131,
+    ),
+    'calc_Madelung_KCl_2D_2': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(),
+        dim=2,
+        reference=-1.6155426267128248,
+    ),
+    'calc_LJ_KCl_2D': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(),
+        dim=2,
+        reference=260.09740337416343,
+    ),
+    'calc_LJ_KCl_2D_2': dict(
+        module='tutorial.calc_limit',
+        kwargs=dict(),
+        dim=2,
+        reference=4.064021927721304,
+    ),
+    # triangular lattice
+    'calc_limit_rhombus': dict(
+        module='hw05.hw05_01',
+        kwargs=dict(gamma=np.pi/3, power=[6, 3]),
+        dim=2,
+        reference=[6.009813927966109, 6.375881552829845],
+    ),
+}
+
+
+def _get_peak_rss():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if platform.system() == 'Darwin' else peak/2**10
+
+
+def _run_case(name, value_range, options, repeat, queue):
+    # time the sums, not the cache
+    set_cache_enabled(False)
+    case = CASES[name]
+    func = getattr(import_module(case['module']), name)
+    kwargs = dict(case['kwargs'], value_range=value_range, **options)
+    rss_before = _get_peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func(**kwargs)
+        times.append(time.perf_counter() - start)
+    queue.put((times, _get_peak_rss(), rss_before, np.asarray(value).tolist()))
+
+
+def _get_output(process, queue, timeout):
+    # poll, so that a child that died without output is noticed at once
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1.0)
+        except Empty:
+            if not process.is_alive():
+                # the output may still be in the pipe
+                try:
+                    return queue.get(timeout=1.0)
+                except Empty:
+                    return None
+            if time.monotonic() > deadline:
+                return None
+
+
+def run_case(name, value_range, options=None, repeat=1,
+             timeout=DEFAULT_TIMEOUT):
+    """
+    time one lattice sum in a fresh process. A case that raises, crashes
+    or runs longer than timeout is recorded with its reason in 'error'
+    and None for the measurements.
+
+    :param name: key of CASES
+    :param value_range:
+    :param options: extra keyword arguments, e.g. workers or backend
+    :param repeat: number of timed calls, the fastest is kept
+    :param timeout: seconds before the process is stopped
+    :return: dict of the measurements
+    """
+    options = options or {}
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(
+        target=_run_case,
+        args=(name, value_range, options, repeat, queue),
+    )
+    process.start()
+    output = _get_output(process, queue, timeout)
+    if output is None and process.is_alive():
+        process.terminate()
+        error = 'timeout after {} s'.format(timeout)
+    else:
+        error = None
+    process.join()
+    if error is None and process.exitcode != 0:
+        error = 'exit code {}'.format(process.exitcode)
+    if error is not None:
+        return {
+            'name': name,
+            'value_range': value_range,
+            'options': options,
+            'error': error,
+            'wall_time': None,
+            'wall_times': None,
+            'peak_rss_mb': None,
+            'rss_increase_mb': None,
+            'value': None,
+            'reference': CASES[name]['reference'],
+            'rel_error': None,
+        }
+
+    times, peak_rss, rss_before, value = output
+    reference = np.asarray(CASES[name]['reference'])
+    rel_error = np.max(np.abs(np.asarray(value) - reference)/np.abs(reference))
+    return {
+        'name': name,
+        'value_range': value_range,
+        'options': options,
+        'error': None,
+        'wall_time': min(times),
+        'wall_times': times,
+        'peak_rss_mb': peak_rss,
+        'rss_increase_mb': peak_rss - rss_before,
+        'value': value,
+        'reference': reference.tolist(),
+        'rel_error': float(rel_error),
+    }
+
+
+def _get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    names=None,
+    value_ranges=DEFAULT_VALUE_RANGES,
+    max_points=DEFAULT_MAX_POINTS,
+    options=None,
+    repeat=1,
+    timeout=DEFAULT_TIMEOUT,
+):
+    """
+    run_case over names and value_ranges, printing one line per case.
+    Cases with more than max_points lattice points are skipped.
+
+    :param names: keys of CASES, all if None
+    :param value_ranges:
+    :param max_points:
+    :param options: extra keyword arguments of every call
+    :param repeat: number of timed calls per case
+    :param timeout: seconds per case
+    :return: dict with the environment and the list of results
+    """
+    results = []
+    for name in names or CASES:
+        for value_range in value_ranges:
+            if (2*value_range + 1)**CASES[name]['dim'] > max_points:
+                print('{:24s} {:6d}  skipped'.format(name, value_range))
+                continue
+            result = run_case(name, value_range, options, repeat, timeout)
+            results.append(result)
+            if result['error'] is not None:
+                print('{:24s} {:6d}  failed: {}'.format(
+                    name, value_range, result['error'],
+                ))
+                continue
+            print('{:24s} {:6d} {:10.4f} s {:8.1f} MB {:10.3e}'.format(
+                name, value_range, result['wall_time'],
+                result['peak_rss_mb'], result['rel_error'],
+            ))
+    return {
+        'commit': _get_commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+
+def _get_results_path(label):
+    return os.path.join(RESULTS_DIR, label + '.json')
+
+
+def save_results(data, label):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(_get_results_path(label), 'w') as fw:
+        json.dump(data, fw, indent=1)
+
+
+def load_results(label):
+    with open(_get_results_path(label)) as fr:
+        return json.load(fr)
+
+
+def compare_results(old, new, time_ratio=1.2, error_ratio=10.0):
+    """
+    print the cases of new that are slower or less accurate than in old
+
+    :param old: data of run_benchmarks or load_results
+    :param new:
+    :param time_ratio: flag wall times growing by more than this factor
+    :param error_ratio: flag relative errors growing by more than this
+        factor, and above 1e-15
+    Failed cases are flagged if they did not fail in old, and skipped
+    otherwise.
+
+    :return: list of (name, value_range, reason)
+    """
+    old_results = {
+        (r['name'], r['value_range']): r for r in old['results']
+    }
+    regressions = []
+    for result in new['results']:
+        key = (result['name'], result['value_range'])
+        if key not in old_results:
+            continue
+        previous = old_results[key]
+        # results saved before failures were recorded have no 'error'
+        if previous.get('error') is not None:
+            continue
+        if result.get('error') is not None:
+            regressions.append(key + ('failed: ' + result['error'], ))
+            continue
+        ratio = result['wall_time']/max(previous['wall_time'], 1e-9)
+        if ratio > time_ratio:
+            regressions.append(key + ('time x{:.2f}'.format(ratio), ))
+        if result['rel_error'] > max(
+            error_ratio*previous['rel_error'], 1e-15,
+        ):
+            regressions.append(key + (
+                'error {:.3e} -> {:.3e}'.format(
+                    previous['rel_error'], result['rel_error'],
+                ),
+            ))
+    for name, value_range, reason in regressions:
+        print('regression {} {}: {}'.format(name, value_range, reason))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--label', default=None,
+                        help='name of the results file, the commit if None')
+    parser.add_argument('--cases', nargs='*', default=None,
+                        choices=sorted(CASES))
+    parser.add_argument('--value-ranges', nargs='*', type=int,
+                        default=DEFAULT_VALUE_RANGES)
+    parser.add_argument('--max-points', type=float, default=DEFAULT_MAX_POINTS)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='seconds per case')
+    # passed only if given, so that earlier code without them still runs
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', default=None)
+    parser.add_argument('--compare', default=None,
+                        help='label of earlier results to compare with')
+    args = parser.parse_args()
+
+    data = run_benchmarks(
+        names=args.cases,
+        value_ranges=args.value_ranges,
+        max_points=args.max_points,
+        options={
+            key: value
+            for key, value in (
+                ('workers', args.workers), ('backend', args.backend),
+            )
+            if value is not None
+        },
+        repeat=args.repeat,
+        timeout=args.timeout,
+    )
+    label = args.label or data['commit'] or 'latest'
+    save_results(data, label)
+    print('saved', _get_results_path(label))
+    if args.compare is not None:
+        compare_results(load_results(args.compare), data)
@@ -1,61 +1,230 @@
+from functools import partial
+
 import numpy as np
 from matplotlib import pyplot as plt
 
+from utils.convergence_utils import register_lattice_sum
+from utils.math_utils import find_roots_bracketed
+from utils.lattice_energy_utils import lennard_jones, relax_lattice
+from utils.lattice_jit_utils import sum_lattice_loop, use_numba
+from utils.lattice_sum_utils import (
+    DEFAULT_BLOCK_SIZE,
+    calc_inverse_power,
+    sum_lattice,
+    sum_lattice_extrapolated,
+    sum_lattice_richardson,
+    sum_lattice_shells,
+    sum_lattice_symmetric,
+)
+
 __author__ = 'Tanjin He'
 __maintainer__ = 'Tanjin He'
 __email__ = 'tanjin_he@berkeley.edu'
 
 
-def calc_limit_rhombus(
-    gamma: float,
-    power: float,
-    value_range=100,
-    with_uv=False,
-):
+def get_lattice_rhombus(gamma: float):
     """
+    unit rhombus, u**2 + v**2 + 2*u*v*cos(gamma) = |(u, v) @ lattice|^2
 
     :param gamma: angle between a and b vectors. Unit: Radian
-    :param power:
-    :param value_range:
     :return:
     """
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
+    return np.array([
+        [1.0, 0.0],
+        [np.cos(gamma), np.sin(gamma)],
+    ])
 
-    u, v = np.meshgrid(u_, v_, indexing='ij')
 
-    result = u**2 + v**2 + 2*u*v*np.cos(gamma)
-    result = result.flatten()
+def term_rhombus(
+    indices: np.ndarray,
+    gamma,
+    power,
+    with_uv=False,
+    dtype=np.float64,
+):
+    """
+    1/r^(2*power) or u*v/r^(2*power) on the unit rhombus,
+    points at r = 0 are left out.
+    power and with_uv may be arrays of the same length, then r^2 and u*v
+    are computed once and one row of terms is returned per power.
+    gamma may be an array as well, then u**2 + v**2 and u*v are shared
+    by all the angles
+
+    :param indices: (n_points, 2) integer array
+    :param gamma: float or (n_gammas, ) array. Unit: Radian
+    :param power: float or (n_powers, ) array
+    :param with_uv: bool or (n_powers, ) array
+    :param dtype: of the terms, see calc_inverse_power
+    :return: array of shape ([n_powers, ][n_gammas, ]n_points)
+    """
+    cos_gamma = np.reshape(np.cos(gamma), np.shape(gamma)+(1, ))
+    trailing = (1, )*(np.ndim(gamma)+1)
+    power = np.reshape(power, np.shape(power)+trailing)
+    with_uv = np.reshape(with_uv, np.shape(with_uv)+trailing)
+
+    effective_indices = np.any(indices != 0, axis=-1)
+    u = indices[effective_indices, 0].astype(float)
+    v = indices[effective_indices, 1].astype(float)
+
+    r_sq = u**2 + v**2 + 2*u*v*cos_gamma
+    result = calc_inverse_power(
+        r_sq, power, dtype, numerator=np.where(with_uv, u*v, 1.0),
+    )
 
-    effective_indices = result.nonzero()
-    result = result[effective_indices]
-    result = np.power(result, power)
-    if with_uv:
-        uv_term = (u*v).flatten()
-        uv_term = uv_term[effective_indices]
-        result = uv_term/result
-    else:
-        result = 1.0/result
+    return result
 
-    result = np.sum(result)
 
-    return result
+def register_lattice_sums():
+    """
+    register the triangular lattice for
+    utils.convergence_utils.run_convergence_study
 
+    :return:
+    """
+    register_lattice_sum(
+        name='rhombus_triangular',
+        term_func=partial(term_rhombus, gamma=np.pi/3, power=[6, 3]),
+        dim=2,
+        exponent=[10, 4],
+    )
 
-def calc_bond_length_rhombus(
+
+def calc_limit_rhombus(
     gamma: float,
-    sigma: float,
+    power,
     value_range=100,
+    with_uv=False,
+    tol=None,
+    symmetric=False,
+    extrapolation=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    dtype=np.float64,
+    backend='numpy',
 ):
-    A_12 = calc_limit_rhombus(
+    """
+    sum of 1/r^(2*power) or u*v/r^(2*power) on the unit rhombus.
+    Pass arrays as power and with_uv to get all the sums in one pass
+    over the lattice.
+
+    :param gamma: angle between a and b vectors. Unit: Radian.
+        float or (n_gammas, ) array to sweep many angles in one pass
+    :param power: float or (n_powers, ) array
+    :param value_range:
+    :param with_uv: bool or (n_powers, ) array
+    :param tol: if given, sum spherical shells until the estimated tail
+        is below tol relative to the sum instead of using value_range.
+        Needs a scalar gamma
+    :param symmetric: sum only the irreducible wedge of the square of
+        indices under (u, v) -> (v, u), (-u, -v), weighted by orbit size
+    :param extrapolation: None, 'tail' or 'richardson', account for the
+        terms outside value_range, see sum_lattice_extrapolated.
+        'tail' needs a scalar gamma and no u*v sums
+    :param block_size: number of terms evaluated at once
+    :param workers: number of processes, None for all cores.
+        Results do not depend on it, not used with tol
+    :param dtype: of the terms, np.float32 is about twice as fast for
+        many angles and powers at once, see calc_inverse_power. The sum
+        is always accumulated in double precision
+    :param backend: 'numpy' or 'numba', a compiled loop without
+        temporary arrays, see sum_lattice_loop. Only for plain sums
+    :return: array of shape ([n_powers, ][n_gammas])
+    """
+    if use_numba(backend, plain=(
+        tol is None and not symmetric and extrapolation is None
+    )):
+        return sum_lattice_loop(
+            lattice=np.reshape(
+                [get_lattice_rhombus(g) for g in np.ravel(gamma)],
+                np.shape(gamma) + (2, 2),
+            ),
+            power=power,
+            value_range=value_range,
+            with_uv=with_uv,
+            block_size=block_size,
+            workers=workers,
+        )
+    term_func = partial(
+        term_rhombus,
         gamma=gamma,
-        power=6,
+        power=power,
+        with_uv=with_uv,
+        dtype=dtype,
+    )
+    if tol is not None:
+        if np.ndim(gamma) > 0:
+            raise ValueError('tol needs a scalar gamma')
+        # |u*v| <= r^2/(2*(1 - |cos(gamma)|)), one order less decay
+        return sum_lattice_shells(
+            term_func=term_func,
+            lattice=get_lattice_rhombus(gamma),
+            tol=tol,
+            power=np.asarray(power, dtype=float) - with_uv,
+            weight=np.where(
+                with_uv, 1/(2*(1 - abs(np.cos(gamma)))), 1.0,
+            ),
+            block_size=block_size,
+        )
+    block_size = max(block_size//np.size(power)//np.size(gamma), 1)
+    if extrapolation == 'tail':
+        if np.ndim(gamma) > 0 or np.any(with_uv):
+            raise ValueError(
+                "'tail' needs a scalar gamma and with_uv=False"
+            )
+        return sum_lattice_extrapolated(
+            term_func=term_func,
+            lattice=get_lattice_rhombus(gamma),
+            value_range=value_range,
+            power=power,
+            method=extrapolation,
+            block_size=block_size,
+            workers=workers,
+        )
+    if extrapolation is not None:
+        # u*v grows like r^2, one order less decay
+        exponent = 2*np.asarray(power, dtype=float) - 2 \
+            - 2*np.asarray(with_uv, dtype=float)
+        return sum_lattice_richardson(
+            term_func=term_func,
+            value_range=value_range,
+            dim=2,
+            exponent=np.reshape(
+                exponent, np.shape(exponent) + (1, )*np.ndim(gamma),
+            ),
+            symmetry='permutation_inversion' if symmetric else None,
+            block_size=block_size,
+            workers=workers,
+        )
+    if symmetric:
+        return sum_lattice_symmetric(
+            term_func=term_func,
+            value_range=value_range,
+            dim=2,
+            symmetry='permutation_inversion',
+            workers=workers,
+        )
+    result = sum_lattice(
+        term_func=term_func,
         value_range=value_range,
+        dim=2,
+        block_size=block_size,
+        workers=workers,
     )
-    A_6 = calc_limit_rhombus(
+
+    return result
+
+
+def calc_bond_length_rhombus(
+    gamma: float,
+    sigma: float,
+    value_range=100,
+    **kwargs,
+):
+    A_12, A_6 = calc_limit_rhombus(
         gamma=gamma,
-        power=3,
+        power=[6, 3],
         value_range=value_range,
+        **kwargs,
     )
     a_0 = (2*A_12/A_6)**(1/6)*sigma
     return a_0
@@ -65,16 +234,13 @@ def calc_cohesive_energy_rhombus(
     gamma: float,
     epsilon: float,
     value_range=100,
+    **kwargs,
 ):
-    A_12 = calc_limit_rhombus(
+    A_12, A_6 = calc_limit_rhombus(
         gamma=gamma,
-        power=6,
-        value_range=value_range,
-    )
-    A_6 = calc_limit_rhombus(
-        gamma=gamma,
-        power=3,
+        power=[6, 3],
         value_range=value_range,
+        **kwargs,
     )
     energy = epsilon*A_6**2/A_12/2
     return energy
@@ -83,30 +249,16 @@ def calc_cohesive_energy_rhombus(
 def calc_rhombus_derivative_gamma(
     gamma: float,
     value_range=100,
+    **kwargs,
 ):
-    A_12 = calc_limit_rhombus(
+    A_12, A_6, A_1_12, A_1_6 = calc_limit_rhombus(
         gamma=gamma,
-        power=6,
-        value_range=value_range,
-    )
-    A_6 = calc_limit_rhombus(
-        gamma=gamma,
-        power=3,
+        power=[6, 3, 7, 4],
+        with_uv=[False, False, True, True],
         value_range=value_range,
+        **kwargs,
     )
     sigma_a_6 = A_6/A_12/2.0
-    A_1_12 = calc_limit_rhombus(
-        gamma=gamma,
-        power=7,
-        value_range=value_range,
-        with_uv=True,
-    )
-    A_1_6 = calc_limit_rhombus(
-        gamma=gamma,
-        power=4,
-        value_range=value_range,
-        with_uv=True,
-    )
     result = sigma_a_6*2*A_1_12-A_1_6
 
     return result
@@ -115,39 +267,14 @@ def calc_rhombus_derivative_gamma(
 def calc_rhombus_derivative_gamma_2(
     gamma: float,
     value_range=100,
+    **kwargs,
 ):
-    A_14 = calc_limit_rhombus(
-        gamma=gamma,
-        power=7,
-        value_range=value_range,
-    )
-    A_12 = calc_limit_rhombus(
-        gamma=gamma,
-        power=6,
-        value_range=value_range,
-    )
-    A_6 = calc_limit_rhombus(
-        gamma=gamma,
-        power=3,
-        value_range=value_range,
-    )
-    A_1_14 = calc_limit_rhombus(
-        gamma=gamma,
-        power=8,
-        value_range=value_range,
-        with_uv=True,
-    )
-    A_1_12 = calc_limit_rhombus(
+    A_14, A_12, A_6, A_1_14, A_1_12, A_1_6 = calc_limit_rhombus(
         gamma=gamma,
-        power=7,
+        power=[7, 6, 3, 8, 7, 4],
+        with_uv=[False, False, False, True, True, True],
         value_range=value_range,
-        with_uv=True,
-    )
-    A_1_6 = calc_limit_rhombus(
-        gamma=gamma,
-        power=4,
-        value_range=value_range,
-        with_uv=True,
+        **kwargs,
     )
     result = A_6/A_14*A_1_14-A_1_6
     # result = A_1_14/A_14
@@ -156,26 +283,125 @@ def calc_rhombus_derivative_gamma_2(
     return result
 
 
-def solve_gamma():
-    all_gammas_deg = np.arange(55,125,0.1)
-    all_gammas_radian = all_gammas_deg/180*np.pi
+def relax_rhombus(
+    sigma: float,
+    epsilon: float,
+    gamma=100/180*np.pi,
+    value_range=30,
+):
+    """
+    relax a, b and gamma of the 2D Lennard-Jones lattice together with a
+    quasi-Newton method on the analytic gradient, instead of scanning
+    gamma and deriving a_0 from it
 
-    # calculate derivation
-    all_dev_gammas = []
-    for gamma in all_gammas_radian:
-        derivative_gamma = calc_rhombus_derivative_gamma(
+    :param sigma:
+    :param epsilon:
+    :param gamma: initial angle. Unit: Radian
+    :param value_range:
+    :return: (a, b, gamma), energy per atom
+    """
+    a_0 = 2**(1/6)*sigma
+    params, energy = relax_lattice(
+        params=[a_0, a_0, gamma],
+        potential=lennard_jones(sigma=sigma, epsilon=epsilon),
+        value_range=value_range,
+    )
+    return params, energy
+
+
+def find_gamma_roots(
+    value_range=30,
+    tol=None,
+    gamma_range=(55/180*np.pi, 125/180*np.pi),
+    num_coarse=15,
+    xtol=1e-10,
+):
+    """
+    all roots of calc_rhombus_derivative_gamma within gamma_range.
+    The coarse grid is evaluated in one vectorized pass unless tol is
+    given, then every sign change is refined with Brent's method to xtol
+
+    :param value_range:
+    :param tol: passed to the lattice sums of the coarse grid and of the
+        refinement steps
+    :param gamma_range: (min, max). Unit: Radian
+    :param num_coarse: number of points of the coarse grid
+    :param xtol: absolute tolerance of the roots. Unit: Radian
+    :return: sorted array of roots. Unit: Radian
+    """
+    def func(gamma):
+        if np.ndim(gamma) > 0 and tol is not None:
+            # tol needs a scalar gamma
+            return np.array([func(x) for x in gamma])
+        # without tol the coarse grid in one pass
+        return calc_rhombus_derivative_gamma(
             gamma=gamma,
-            value_range=30,
+            value_range=value_range,
+            tol=tol,
         )
-        all_dev_gammas.append(derivative_gamma)
-    all_dev_gammas = np.array(all_dev_gammas)
+
+    roots = find_roots_bracketed(
+        func=func,
+        x_grid=np.linspace(gamma_range[0], gamma_range[1], num_coarse),
+        xtol=xtol,
+    )
+    return roots
+
+
+def solve_gamma(value_range=30, vectorized=True, method='root', plot=True):
+    """
+
+    :param value_range:
+    :param vectorized: evaluate all the angles in one pass over the
+        lattice instead of one lattice sum per angle
+    :param method: 'root' refines the sign changes of the derivative with
+        Brent's method, 'scan' takes the grid point with the smallest
+        derivative. Both only consider gamma >= 100 deg
+    :param plot: plot the derivative on the grid of the scan
+    :return:
+    """
+    all_gammas_deg = np.arange(55,125,0.1)
+    all_gammas_radian = all_gammas_deg/180*np.pi
 
     # find gamma
-    all_dev_gammas_abs = np.abs(all_dev_gammas)
-    all_dev_gammas_abs[all_gammas_deg<100] = np.inf
-    index_gamma = np.argmin(all_dev_gammas_abs)
-    gamma_deg_opt = all_gammas_deg[index_gamma]
-    gamma_rad_opt = all_gammas_radian[index_gamma]
+    if method == 'root':
+        roots = find_gamma_roots(
+            value_range=value_range,
+            gamma_range=(100/180*np.pi, all_gammas_radian[-1]),
+        )
+        if len(roots) == 0:
+            raise ValueError(
+                'no sign change of the derivative between 100 and {:.1f} '
+                'deg, try method=\'scan\''.format(all_gammas_deg[-1])
+            )
+        gamma_rad_opt = roots[0]
+        if not plot:
+            return gamma_rad_opt
+
+    # calculate derivation, for the scan and the plot
+    if vectorized:
+        all_dev_gammas = calc_rhombus_derivative_gamma(
+            gamma=all_gammas_radian,
+            value_range=value_range,
+        )
+    else:
+        all_dev_gammas = []
+        for gamma in all_gammas_radian:
+            derivative_gamma = calc_rhombus_derivative_gamma(
+                gamma=gamma,
+                value_range=value_range,
+            )
+            all_dev_gammas.append(derivative_gamma)
+        all_dev_gammas = np.array(all_dev_gammas)
+
+    if method != 'root':
+        all_dev_gammas_abs = np.abs(all_dev_gammas)
+        all_dev_gammas_abs[all_gammas_deg<100] = np.inf
+        index_gamma = np.argmin(all_dev_gammas_abs)
+        gamma_deg_opt = all_gammas_deg[index_gamma]
+        gamma_rad_opt = all_gammas_radian[index_gamma]
+    if not plot:
+        return gamma_rad_opt
 
     fig = plt.figure(
         figsize=(12, 10),
@@ -221,4 +447,12 @@ if __name__ == '__main__':
         epsilon=epsilon,
         value_range=30,
     )
-    print('e_coh', e_coh)
\ No newline at end of file
+    print('e_coh', e_coh)
+
+    params, energy = relax_rhombus(
+        sigma=sigma,
+        epsilon=epsilon,
+        value_range=30,
+    )
+    print('relaxed (a, b, gamma)', params)
+    print('relaxed energy', energy)
\ No newline at end of file
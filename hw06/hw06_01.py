@@ -6,6 +6,12 @@ from utils.constants import (
     eV_to_J,
     ang_to_m,
 )
+from utils.crystal_utils import (
+    Crystal,
+    calc_alternating_sum,
+    calc_lattice_sum,
+    calc_Madelung,
+)
 
 
 __author__ = 'Tanjin He'
@@ -13,130 +19,110 @@ __maintainer__ = 'Tanjin He'
 __email__ = 'tanjin_he@berkeley.edu'
 
 
+# square lattice with K at (0, 0) and Cl at (1/2, 1/2)
+LATTICE_KCl_2D_uv = np.eye(2)
+BASIS_KCl_2D_uv = np.array([
+    [0.0, 0.0],
+    [0.5, 0.5],
+])
+# the same layer with nearest neighbor distance 1,
+# i.e. charge (-1)^(u+v) at (u, v)
+LATTICE_KCl_2D_ij = np.array([
+    [1.0, 1.0],
+    [1.0, -1.0],
+])
+BASIS_KCl_2D_ij = np.array([
+    [0.0, 0.0],
+    [0.5, 0.5],
+])
+
+CRYSTAL_KCl_2D_uv = Crystal(
+    lattice=LATTICE_KCl_2D_uv,
+    basis=BASIS_KCl_2D_uv,
+    charges=[1.0, -1.0],
+    species=['K', 'Cl'],
+)
+CRYSTAL_KCl_2D_ij = Crystal(
+    lattice=LATTICE_KCl_2D_ij,
+    basis=BASIS_KCl_2D_ij,
+    charges=[1.0, -1.0],
+    species=['K', 'Cl'],
+)
+CRYSTAL_SQUARE = Crystal(lattice=np.eye(2), basis=[[0.0, 0.0]])
+
 
-def calc_Madelung_KCl_2D_uv(value_range=100):
+def calc_Madelung_KCl_2D_uv(value_range=100, method='direct', **kwargs):
     """
-    Seems not correct? Why?
+    The direct sum over a square converges to the Madelung constant
+    only as 1/value_range, method='ewald' gives it directly.
 
     :param value_range:
-    :return:
+    :param method: 'direct' or 'ewald'
+    :param kwargs: see calc_Madelung
+    :return: Madelung sum[, error]
     """
-
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v = np.meshgrid(u_, v_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    A_1 = (u**2 + v**2)
-    A_1 = A_1.flatten()
-    A_1 = np.power(A_1, 0.5)
-    A_1 = 1.0 / A_1
-    A_1[np.isinf(A_1)] = 0.0
-
-    # A_2 = ((u+v+1)**2 + (v+w+1)**2 + (w+u+1)**2)/4
-    A_2 = ((u+0.5)**2 + (v+0.5)**2 )
-    A_2 = A_2.flatten()
-    A_2 = np.power(A_2, 0.5)
-    A_2 = 1.0 / A_2
-
-    result = A_1 - A_2
-    result = np.sum(result)
-
-    return result
+    return calc_Madelung(
+        crystal=CRYSTAL_KCl_2D_uv,
+        value_range=value_range,
+        method=method,
+        **kwargs,
+    )
 
 
-def calc_Madelung_KCl_2D_ij(value_range=100):
+def calc_Madelung_KCl_2D_ij(value_range=100, method='direct', **kwargs):
     """
-    Seems not correct? Why?
+    The direct sum over a square converges to the Madelung constant
+    only as 1/value_range, method='ewald' gives it directly.
+    The direct sum runs over the square of (u, v) with charge (-1)^(u+v).
 
     :param value_range:
-    :return:
+    :param method: 'direct' or 'ewald'
+    :param kwargs: see calc_alternating_sum, or calc_Madelung for 'ewald'
+    :return: Madelung sum[, error]
     """
-
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v = np.meshgrid(u_, v_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    A_1 = (-1.0)**(u+v)/np.sqrt(u**2 + v**2)
-    A_1 = A_1.flatten()
-    A_1[np.isinf(A_1)] = 0.0
-
-    result = np.sum(A_1)
-
-    return result
-
-
-
+    if method == 'ewald':
+        return calc_Madelung(
+            crystal=CRYSTAL_KCl_2D_ij, method=method, **kwargs,
+        )
+
+    return calc_alternating_sum(
+        lattice=np.eye(2),
+        power=0.5,
+        value_range=value_range,
+        **kwargs,
+    )
 
 
-def calc_LJ_KCl_2D_uv(value_range=100):
+def calc_LJ_KCl_2D_uv(value_range=100, **kwargs):
     """
-    Seems not correct? Why?
+    sum of 1/r^12 over both sublattices of the KCl layer
 
-    :param value_range:
+    :param value_range: half width of the summed square of indices
+    :param kwargs: see calc_lattice_sum
     :return:
     """
-
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v = np.meshgrid(u_, v_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    A_1 = (u**2 + v**2)
-    A_1 = A_1.flatten()
-    A_1 = np.power(A_1, 6)
-    A_1 = 1.0 / A_1
-    A_1[np.isinf(A_1)] = 0.0
-
-    # A_2 = ((u+v+1)**2 + (v+w+1)**2 + (w+u+1)**2)/4
-    A_2 = ((u+0.5)**2 + (v+0.5)**2 )
-    A_2 = A_2.flatten()
-    A_2 = np.power(A_2, 6)
-    A_2 = 1.0 / A_2
-
-    result = A_1 + A_2
-    result = np.sum(result)
-
-    return result
+    return calc_lattice_sum(
+        crystal=CRYSTAL_KCl_2D_uv,
+        power=6,
+        value_range=value_range,
+        **kwargs,
+    )
 
 
-def calc_LJ_KCl_2D_ij(value_range=100):
+def calc_LJ_KCl_2D_ij(value_range=100, **kwargs):
     """
-    Seems not correct? Why?
+    sum of 1/(i**2 + j**2)**6
 
-    :param value_range:
+    :param value_range: half width of the summed square of indices
+    :param kwargs: see calc_lattice_sum
     :return:
     """
-
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v = np.meshgrid(u_, v_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    A_1 = 1.0/(u**2 + v**2)**6
-    A_1 = A_1.flatten()
-    A_1[np.isinf(A_1)] = 0.0
-
-    result = np.sum(A_1)
-
-    return result
+    return calc_lattice_sum(
+        crystal=CRYSTAL_SQUARE,
+        power=6,
+        value_range=value_range,
+        **kwargs,
+    )
 
 
 
@@ -144,12 +130,26 @@ def calc_distance_KCl(
     sigma: float,
     epsilon: float,
     value_range=100,
+    method='direct',
+    tol=None,
 ):
+    """
+
+    :param sigma:
+    :param epsilon:
+    :param value_range:
+    :param method: 'direct' or 'ewald' for the Madelung sum
+    :param tol: if given, converge the Lennard-Jones sum to tol
+        instead of using value_range
+    :return:
+    """
     sum_1 = calc_Madelung_KCl_2D_ij(
         value_range=value_range,
+        method=method,
     )
     sum_2 = calc_LJ_KCl_2D_ij(
         value_range=value_range,
+        tol=tol,
     )
     coeff_1 = charge_elementary**2/4/np.pi/permittivity_vacuum*sum_1
     coeff_2 = 4*epsilon*sigma**12*sum_2
@@ -164,12 +164,27 @@ def calc_cohesive_energy_KCl(
     sigma: float,
     epsilon: float,
     value_range=100,
+    method='direct',
+    tol=None,
 ):
+    """
+
+    :param d:
+    :param sigma:
+    :param epsilon:
+    :param value_range:
+    :param method: 'direct' or 'ewald' for the Madelung sum
+    :param tol: if given, converge the Lennard-Jones sum to tol
+        instead of using value_range
+    :return:
+    """
     sum_1 = calc_Madelung_KCl_2D_ij(
         value_range=value_range,
+        method=method,
     )
     sum_2 = calc_LJ_KCl_2D_ij(
         value_range=value_range,
+        tol=tol,
     )
     coeff_1 = charge_elementary**2/4/np.pi/permittivity_vacuum*sum_1
     coeff_2 = 4*epsilon*sigma**12*sum_2
@@ -187,7 +202,8 @@ if __name__ == '__main__':
     d_0 = calc_distance_KCl(
         sigma=sigma,
         epsilon=epsilon,
-        value_range=1000,
+        method='ewald',
+        tol=1e-12,
     )
     print('d_0', d_0/ang_to_m)
 
@@ -195,7 +211,8 @@ if __name__ == '__main__':
         d=d_0,
         sigma=sigma,
         epsilon=epsilon,
-        value_range=1000,
+        method='ewald',
+        tol=1e-12,
     )
     print('e_coh', e_coh/eV_to_J)
 
@@ -1,6 +1,7 @@
 import numpy as np
 from matplotlib import pyplot as plt
 
+from utils.tight_binding_utils import build_chain_matrices, solve_lcao
 
 __author__ = 'Tanjin He'
 __maintainer__ = 'Tanjin He'
@@ -275,8 +276,8 @@ def plot_2c(save_fig=False, show_fig=False):
     energy_level_length = 1
     E_1 = -4
     E_2 = -2
-    E_m = -3-np.sqrt(5)
-    E_p = -3+np.sqrt(5)
+    # coupling of 2 eV, giving E = -3 -+ sqrt(5)
+    (E_m, E_p), _ = solve_lcao(*build_chain_matrices([E_1, E_2], -2.))
 
     fig = plt.figure(
         figsize=(12, 8),
@@ -371,14 +372,14 @@ def plot_2c(save_fig=False, show_fig=False):
     ax.text(
         (center_1+center_2)/2-0.5,
         E_m-0.35,
-        'E$^-$=-5.236 eV',
+        'E$^-$={:.3f} eV'.format(E_m),
         fontsize=28,
         color='tab:green',
     )
     ax.text(
         (center_1+center_2)/2-0.5,
         E_p+0.15,
-        'E$^+$=-0.764 eV',
+        'E$^+$={:.3f} eV'.format(E_p),
         fontsize=28,
         color='tab:cyan',
         )
@@ -1,7 +1,12 @@
 import numpy as np
 from matplotlib import pyplot as plt
 
-from utils.constants import hbar, m_e, k_B, J_to_eV, eV_to_J, ang_to_m
+from utils.constants import k_B, J_to_eV, eV_to_J, ang_to_m
+from utils.kronig_penney_utils import (
+    calc_f_KP,
+    find_band_edges,
+    get_KP_scan_grid,
+)
 
 __author__ = 'Tanjin He'
 __maintainer__ = 'Tanjin He'
@@ -14,6 +19,8 @@ def f_KP(
     V_0,
 ):
     """
+    see utils.kronig_penney_utils.calc_f_KP, E may have any shape and
+    order, and a, b and V_0 may be arrays broadcasting against it
 
     :param E: unit J
     :param a: unit m
@@ -21,82 +28,7 @@ def f_KP(
     :param V_0: unit J
     :return:
     """
-    def f_cosh_beta_b(E_input):
-        E_1 = E_input[V_0 - E_input >= 0]
-        beta_1 = np.sqrt(2 * m_e * (V_0 - E_1) / hbar ** 2)
-        result_1 = np.cosh(beta_1*b)
-
-        E_2 = E_input[V_0 - E_input < 0]
-        # imaginary part
-        beta_2 = np.sqrt(2 * m_e * (E_2 - V_0) / hbar ** 2)
-        result_2 = np.cos(beta_2*b)
-
-        return np.concatenate([result_1, result_2], axis=-1)
-
-    def f_beta_square(E_input):
-        return 2*m_e*(V_0-E_input)/hbar**2
-
-    def f_sinh_beta_b_over_beta(E_input):
-        E_1 = E_input[V_0 - E_input > 0]
-        beta_1 = np.sqrt(2 * m_e * (V_0 - E_1) / hbar ** 2)
-        result_1 = np.sinh(beta_1 * b)/beta_1
-
-        E_2 = E_input[V_0 - E_input == 0.0]
-        result_2 = b*np.ones_like(E_2)
-
-        E_3 = E_input[V_0 - E_input < 0]
-        # imaginary part
-        beta_3 = np.sqrt(2 * m_e * (E_3 - V_0) / hbar ** 2)
-        result_3 = np.sin(beta_3 * b)/beta_3
-
-        return np.concatenate([result_1, result_2, result_3], axis=-1)
-
-    def f_cos_alpha_a(E_input):
-        E_1 = E_input[E_input < 0]
-        alpha_1 = np.sqrt(- 2 * m_e * E_1 / hbar ** 2)
-        result_1 = np.cosh(alpha_1*a)
-
-        E_2 = E_input[E_input >= 0]
-        # imaginary part
-        alpha_2 = np.sqrt(2 * m_e * E_2 / hbar ** 2)
-        result_2 = np.cos(alpha_2*a)
-
-        return np.concatenate([result_1, result_2], axis=-1)
-
-    def f_alpha_square(E_input):
-        return 2*m_e*E_input/hbar**2
-
-    def f_sin_alpha_a_over_alpha(E_input):
-        E_1 = E_input[E_input < 0]
-        # imaginary part
-        alpha_1 = np.sqrt(-2 * m_e * E_1 / hbar ** 2)
-        result_1 = np.sinh(alpha_1*a)/alpha_1
-
-        E_2 = E_input[E_input == 0.0]
-        result_2 = b*np.ones_like(E_2)
-
-        E_3 = E_input[E_input > 0]
-        alpha_3 = np.sqrt(2 * m_e * E_3 / hbar ** 2)
-        result_3 = np.sin(alpha_3 * a)/alpha_3
-
-        return np.concatenate([result_1, result_2, result_3], axis=-1)
-
-    y = (
-        f_cos_alpha_a(E)*f_cosh_beta_b(E)
-        + (f_beta_square(E)-f_alpha_square(E))/2
-        * f_sin_alpha_a_over_alpha(E)
-        *f_sinh_beta_b_over_beta(E)
-    )
-
-    # alpha = np.sqrt(2*m_e*E)/hbar
-    # beta = np.sqrt(2*m_e*(V_0 - E))/hbar
-    # print('beta', beta)
-    # y = (
-    #     np.cos(alpha*a)*np.cosh(beta*b)
-    #     + (beta**2-alpha**2)/2/alpha/beta*np.sin(alpha*a)*np.sinh(beta*b)
-    # )
-
-    return y
+    return calc_f_KP(E=E, a=a, b=b, V_0=V_0)
 
 
 def find_intersection(E, y):
@@ -107,11 +39,8 @@ def find_intersection(E, y):
 
 
 def plot_2a(save_fig=False, show_fig=False):
-    step = 0.0001*eV_to_J
-    # step = 0.1*eV_to_J
-    # E = np.arange(0, V_0+step, step)
-    # E = np.arange(0, V_0, step)
-    E = np.arange(step, 100*V_0, step)
+    # uniform in sqrt(E), i.e. in the phase of f, smooth for plotting
+    E = get_KP_scan_grid(a=a, b=b, E_max=100*V_0, points_per_period=256)
     y = f_KP(
         E=E,
         a=a,
@@ -119,8 +48,15 @@ def plot_2a(save_fig=False, show_fig=False):
         V_0=V_0,
     )
     print('y', y)
-    E_crossing = find_intersection(E, y)
+    E_crossing, bands = find_band_edges(
+        a=a,
+        b=b,
+        V_0=V_0,
+        E_max=100*V_0,
+        return_bands=True,
+    )
     print('E_crossing', len(E_crossing), E_crossing*J_to_eV)
+    print('bands', bands*J_to_eV)
 
     fig = plt.figure(
         figsize=(12, 8),
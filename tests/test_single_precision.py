@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from hw05.hw05_01 import calc_limit_rhombus, term_rhombus
+from utils.cache_utils import set_cache_enabled
+from utils.lattice_sum_utils import (
+    calc_inverse_power,
+    calc_single_precision_bound,
+    get_index_block,
+)
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+@pytest.fixture(autouse=True)
+def no_cache():
+    previous = set_cache_enabled(False)
+    yield
+    set_cache_enabled(previous)
+
+
+@pytest.mark.parametrize('power', [0.5, 1.0, 3.0, 3.5, 6.0, 8.0])
+def test_inverse_power(power):
+    r_sq = np.random.default_rng(0).uniform(1.0, 1e4, 10**5)
+    double = calc_inverse_power(r_sq, power)
+    single = calc_inverse_power(r_sq, power, dtype=np.float32)
+    assert single.dtype == np.float32
+    assert np.all(
+        np.abs(single - double)
+        <= calc_single_precision_bound(power, double, 1)
+    )
+
+
+def test_rhombus_angles():
+    value_range = 30
+    gamma = np.linspace(55, 125, 71)/180*np.pi
+    power = np.array([6, 3])
+    double = calc_limit_rhombus(gamma, power, value_range=value_range)
+    single = calc_limit_rhombus(
+        gamma, power, value_range=value_range, dtype=np.float32,
+    )
+    assert single.shape == (2, 71)
+    # all terms are positive, so sum|t| is the sum itself
+    assert np.all(np.abs(single - double) <= calc_single_precision_bound(
+        power[:, np.newaxis], double, (2*value_range + 1)**2,
+    ))
+
+
+def test_rhombus_uv():
+    value_range = 30
+    gamma = np.pi/3
+    power = np.array([6, 3])
+    with_uv = np.array([True, True])
+    double = calc_limit_rhombus(
+        gamma, power, value_range=value_range, with_uv=with_uv,
+    )
+    single = calc_limit_rhombus(
+        gamma, power, value_range=value_range, with_uv=with_uv,
+        dtype=np.float32,
+    )
+    indices = get_index_block(0, (2*value_range + 1)**2, value_range, 2)
+    abs_sum = np.sum(np.abs(
+        term_rhombus(indices, gamma, power, with_uv=with_uv)
+    ), axis=-1)
+    assert np.all(np.abs(single - double) <= calc_single_precision_bound(
+        power, abs_sum, len(indices),
+    ))
@@ -1,278 +1,319 @@
+from functools import partial
+
 import numpy as np
 
+from utils.convergence_utils import register_lattice_sum
+from utils.crystal_utils import (
+    Crystal,
+    calc_alternating_sum,
+    calc_lattice_sum,
+    calc_Madelung,
+    get_term_func,
+)
+from utils.lattice_sum_utils import term_alternating
+
 
 __author__ = 'Tanjin He'
 __maintainer__ = 'Tanjin He'
 __email__ = 'tanjin_he@berkeley.edu'
 
 
-def calc_limit_cubic(power, value_range=100):
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-    w_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    # u_ = np.arange(0, value_range+1, dtype=float)
-    # v_ = np.arange(0, value_range+1, dtype=float)
-    # w_ = np.arange(0, value_range+1, dtype=float)
-
-    u, v, w = np.meshgrid(u_, v_, w_, indexing='ij')
-    # u, v = np.meshgrid(u_, v_, indexing='ij')
-    # print('u_', u_)
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    result = u**2 + v**2 + w**2
-    # result = u**2 + v**2
-    result = result.flatten()
-
-    # print('result', result)
-    # print('np.sum(result)', np.sum(result))
-
-    result = result[result.nonzero()]
-    result = np.power(result, power)
-    result = 1.0/result
-    # result[np.isinf(result)] = 0
-    result = np.sum(result)
-
-    return result
-
-
-def calc_limit_FCC(power, value_range=100):
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-    w_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v, w = np.meshgrid(u_, v_, w_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    result = ((u+v)**2 + (v+w)**2 + (w+u)**2)/4
-    result = result.flatten()
-    result = result[result.nonzero()]
-    result = np.power(result, power)
-    result = 1.0/result
-    result = np.sum(result)
-
-    return result
-
-
-def calc_limit_NaCl(power, value_range=100):
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-    w_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v, w = np.meshgrid(u_, v_, w_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    result = ((u+v+1)**2 + (v+w+1)**2 + (w+u+1)**2)/4
-    result = result.flatten()
-    result = result[result.nonzero()]
-    result = np.power(result, power)
-    result = 1.0/result
-    result = np.sum(result)
-
-    return result
-
-
-def calc_limit_NaCl_2(power, value_range=100):
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-    w_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v, w = np.meshgrid(u_, v_, w_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    # result = ((u+v+1)**2 + (v+w+1)**2 + (w+u-1)**2)/4
-    result = ((u+v)**2 + (v+w)**2 + (w+u+1)**2)/4
-    result = result.flatten()
-    result = result[result.nonzero()]
-    result = np.power(result, power)
-    result = 1.0/result
-    result = np.sum(result)
-
-    return result
-
-
-def calc_Madelung_NaCl(value_range=100):
+LATTICE_CUBIC = np.eye(3)
+# FCC primitive vectors in units of the cubic lattice parameter,
+# i.e. (u, v, w) -> ((u+v)/2, (v+w)/2, (w+u)/2)
+LATTICE_FCC = np.array([
+    [0.5, 0.0, 0.5],
+    [0.5, 0.5, 0.0],
+    [0.0, 0.5, 0.5],
+])
+# Na at the origin, Cl at (1/2, 1/2, 1/2) in Cartesian coordinates,
+# which is also (1/2, 1/2, 1/2) in fractional coordinates of LATTICE_FCC
+BASIS_NaCl = np.array([
+    [0.0, 0.0, 0.0],
+    [0.5, 0.5, 0.5],
+])
+# square lattice with K at (0, 0) and Cl at (1/2, 1/2)
+LATTICE_KCl_2D = np.eye(2)
+BASIS_KCl_2D = np.array([
+    [0.0, 0.0],
+    [0.5, 0.5],
+])
+# the same layer with nearest neighbor distance 1,
+# i.e. charge (-1)^(u+v) at (u, v)
+LATTICE_KCl_2D_2 = np.array([
+    [1.0, 1.0],
+    [1.0, -1.0],
+])
+BASIS_KCl_2D_2 = np.array([
+    [0.0, 0.0],
+    [0.5, 0.5],
+])
+
+CRYSTAL_CUBIC = Crystal(lattice=LATTICE_CUBIC, basis=[[0.0, 0.0, 0.0]])
+CRYSTAL_FCC = Crystal(lattice=LATTICE_FCC, basis=[[0.0, 0.0, 0.0]])
+CRYSTAL_NaCl = Crystal(
+    lattice=LATTICE_FCC,
+    basis=BASIS_NaCl,
+    charges=[1.0, -1.0],
+    species=['Na', 'Cl'],
+)
+# FCC and a copy shifted by (0, 0, 1/2) in Cartesian coordinates
+CRYSTAL_NaCl_2 = Crystal(
+    lattice=LATTICE_FCC,
+    basis=[[0.0, 0.0, 0.0], [0.5, -0.5, 0.5]],
+)
+CRYSTAL_KCl_2D = Crystal(
+    lattice=LATTICE_KCl_2D,
+    basis=BASIS_KCl_2D,
+    charges=[1.0, -1.0],
+    species=['K', 'Cl'],
+)
+CRYSTAL_KCl_2D_2 = Crystal(
+    lattice=LATTICE_KCl_2D_2,
+    basis=BASIS_KCl_2D_2,
+    charges=[1.0, -1.0],
+    species=['K', 'Cl'],
+)
+CRYSTAL_SQUARE = Crystal(lattice=np.eye(2), basis=[[0.0, 0.0]])
+
+
+def register_lattice_sums():
     """
-    Seems not correct? Why?
+    register the sums of this module for
+    utils.convergence_utils.run_convergence_study. The tails of
+    1/r^(2*power) decay as N^-(2*power - dim). The direct 2D Madelung
+    sums over squares converge to the Ewald value as 1/N, the 3D one
+    over cubes is only conditionally convergent
 
-    :param value_range:
     :return:
     """
-
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-    w_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v, w = np.meshgrid(u_, v_, w_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    A_1 = ((u+v)**2 + (v+w)**2 + (w+u)**2)/4
-    A_1 = A_1.flatten()
-    A_1 = np.power(A_1, 0.5)
-    A_1 = 1.0 / A_1
-    A_1[np.isinf(A_1)] = 0.0
-
-    A_2 = ((u+v+1)**2 + (v+w+1)**2 + (w+u+1)**2)/4
-    # A_2 = ((u+v)**2 + (v+w)**2 + (w+u+1)**2)/4
-    A_2 = A_2.flatten()
-    A_2 = np.power(A_2, 0.5)
-    A_2 = 1.0 / A_2
-
-    result = A_1 - A_2
-    result = np.sum(result)
-
-    return result
-
-
-def calc_Madelung_KCl_2D(value_range=100):
+    for name, crystal, weights in [
+        ('cubic', CRYSTAL_CUBIC, None),
+        ('FCC', CRYSTAL_FCC, None),
+        ('NaCl', CRYSTAL_NaCl, [0.0, 1.0]),
+        ('NaCl_2', CRYSTAL_NaCl_2, [0.0, 1.0]),
+    ]:
+        register_lattice_sum(
+            name=name,
+            term_func=get_term_func(crystal, power=[6, 3], weights=weights),
+            dim=3,
+            exponent=[9, 3],
+        )
+    register_lattice_sum(
+        name='Madelung_NaCl',
+        term_func=get_term_func(
+            CRYSTAL_NaCl,
+            power=0.5,
+            weights=CRYSTAL_NaCl.charges[0]*CRYSTAL_NaCl.charges,
+        ),
+        dim=3,
+        conditional=True,
+    )
+    register_lattice_sum(
+        name='Madelung_KCl_2D',
+        term_func=get_term_func(
+            CRYSTAL_KCl_2D,
+            power=0.5,
+            weights=CRYSTAL_KCl_2D.charges[0]*CRYSTAL_KCl_2D.charges,
+        ),
+        dim=2,
+        exponent=1,
+    )
+    register_lattice_sum(
+        name='Madelung_KCl_2D_2',
+        term_func=partial(term_alternating, lattice=np.eye(2), power=0.5),
+        dim=2,
+        exponent=1,
+    )
+    for name, crystal in [
+        ('LJ_KCl_2D', CRYSTAL_KCl_2D),
+        ('LJ_KCl_2D_2', CRYSTAL_SQUARE),
+    ]:
+        register_lattice_sum(
+            name=name,
+            term_func=get_term_func(crystal, power=6),
+            dim=2,
+            exponent=10,
+        )
+
+
+def calc_limit_cubic(power, value_range=100, symmetric=False, **kwargs):
     """
-    Seems not correct? Why?
+    simple cubic, u**2 + v**2 + w**2
 
-    :param value_range:
+    :param power: float or (n_powers, ) array, summed in one pass
+    :param value_range: half width of the summed cube of indices
+    :param symmetric: sum only the irreducible wedge (48 operations)
+    :param kwargs: see calc_lattice_sum
     :return:
     """
+    return calc_lattice_sum(
+        crystal=CRYSTAL_CUBIC,
+        power=power,
+        value_range=value_range,
+        symmetry='cubic' if symmetric else None,
+        **kwargs,
+    )
 
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v = np.meshgrid(u_, v_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
-
-    A_1 = (u**2 + v**2)
-    A_1 = A_1.flatten()
-    A_1 = np.power(A_1, 0.5)
-    A_1 = 1.0 / A_1
-    A_1[np.isinf(A_1)] = 0.0
-
-    # A_2 = ((u+v+1)**2 + (v+w+1)**2 + (w+u+1)**2)/4
-    A_2 = ((u+0.5)**2 + (v+0.5)**2 )
-    A_2 = A_2.flatten()
-    A_2 = np.power(A_2, 0.5)
-    A_2 = 1.0 / A_2
-
-    result = A_1 - A_2
-    result = np.sum(result)
 
-    return result
-
-
-def calc_Madelung_KCl_2D_2(value_range=100):
+def calc_limit_FCC(power, value_range=100, symmetric=False, **kwargs):
     """
-    Seems not correct? Why?
+    FCC, ((u+v)**2 + (v+w)**2 + (w+u)**2)/4
 
-    :param value_range:
+    :param power: float or (n_powers, ) array, summed in one pass
+    :param value_range: half width of the summed cube of indices
+    :param symmetric: sum only the irreducible wedge (12 operations)
+    :param kwargs: see calc_lattice_sum
     :return:
     """
+    return calc_lattice_sum(
+        crystal=CRYSTAL_FCC,
+        power=power,
+        value_range=value_range,
+        symmetry='permutation_inversion' if symmetric else None,
+        **kwargs,
+    )
 
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v = np.meshgrid(u_, v_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
 
-    A_1 = (-1.0)**(u+v)/np.sqrt(u**2 + v**2)
-    A_1 = A_1.flatten()
-    A_1[np.isinf(A_1)] = 0.0
-
-    result = np.sum(A_1)
+def calc_limit_NaCl(power, value_range=100, **kwargs):
+    """
+    FCC shifted by (1/2, 1/2, 1/2), i.e. the Cl sites seen from Na,
+    ((u+v+1)**2 + (v+w+1)**2 + (w+u+1)**2)/4
 
-    return result
+    :param power: float or (n_powers, ) array, summed in one pass
+    :param value_range: half width of the summed cube of indices
+    :param kwargs: see calc_lattice_sum
+    :return:
+    """
+    return calc_lattice_sum(
+        crystal=CRYSTAL_NaCl,
+        power=power,
+        weights=[0.0, 1.0],
+        value_range=value_range,
+        **kwargs,
+    )
 
 
+def calc_limit_NaCl_2(power, value_range=100, **kwargs):
+    """
+    FCC shifted by (0, 0, 1/2),
+    ((u+v)**2 + (v+w)**2 + (w+u+1)**2)/4
 
+    :param power: float or (n_powers, ) array, summed in one pass
+    :param value_range: half width of the summed cube of indices
+    :param kwargs: see calc_lattice_sum
+    :return:
+    """
+    return calc_lattice_sum(
+        crystal=CRYSTAL_NaCl_2,
+        power=power,
+        weights=[0.0, 1.0],
+        value_range=value_range,
+        **kwargs,
+    )
 
 
-def calc_LJ_KCl_2D(value_range=100):
+def calc_Madelung_NaCl(value_range=100, method='direct', **kwargs):
     """
-    Seems not correct? Why?
+    The direct sum over a cube is only conditionally convergent,
+    so it converges slowly and to a shape dependent value.
+    Use method='ewald' for the converged Madelung constant.
 
     :param value_range:
-    :return:
+    :param method: 'direct' or 'ewald'
+    :param kwargs: see calc_Madelung
+    :return: Madelung sum[, error]
     """
+    return calc_Madelung(
+        crystal=CRYSTAL_NaCl,
+        value_range=value_range,
+        method=method,
+        **kwargs,
+    )
 
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
 
-    u, v = np.meshgrid(u_, v_, indexing='ij')
+def calc_Madelung_KCl_2D(value_range=100, method='direct', **kwargs):
+    """
+    The direct sum over a square converges to the Madelung constant
+    only as 1/value_range, method='ewald' gives it directly.
 
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
+    :param value_range:
+    :param method: 'direct' or 'ewald'
+    :param kwargs: see calc_Madelung
+    :return: Madelung sum[, error]
+    """
+    return calc_Madelung(
+        crystal=CRYSTAL_KCl_2D,
+        value_range=value_range,
+        method=method,
+        **kwargs,
+    )
 
-    A_1 = (u**2 + v**2)
-    A_1 = A_1.flatten()
-    A_1 = np.power(A_1, 6)
-    A_1 = 1.0 / A_1
-    A_1[np.isinf(A_1)] = 0.0
 
-    # A_2 = ((u+v+1)**2 + (v+w+1)**2 + (w+u+1)**2)/4
-    A_2 = ((u+0.5)**2 + (v+0.5)**2 )
-    A_2 = A_2.flatten()
-    A_2 = np.power(A_2, 6)
-    A_2 = 1.0 / A_2
+def calc_Madelung_KCl_2D_2(value_range=100, method='direct', **kwargs):
+    """
+    The direct sum over a square converges to the Madelung constant
+    only as 1/value_range, method='ewald' gives it directly.
+    The direct sum runs over the square of (u, v) with charge (-1)^(u+v).
 
-    result = A_1 + A_2
-    result = np.sum(result)
+    :param value_range:
+    :param method: 'direct' or 'ewald'
+    :param kwargs: see calc_alternating_sum, or calc_Madelung for 'ewald'
+    :return: Madelung sum[, error]
+    """
+    if method == 'ewald':
+        return calc_Madelung(
+            crystal=CRYSTAL_KCl_2D_2, method=method, **kwargs,
+        )
 
-    return result
+    return calc_alternating_sum(
+        lattice=np.eye(2),
+        power=0.5,
+        value_range=value_range,
+        **kwargs,
+    )
 
 
-def calc_LJ_KCl_2D_2(value_range=100):
+def calc_LJ_KCl_2D(value_range=100, **kwargs):
     """
-    Seems not correct? Why?
+    sum of 1/r^12 over both sublattices of the KCl layer
 
-    :param value_range:
+    :param value_range: half width of the summed square of indices
+    :param kwargs: see calc_lattice_sum
     :return:
     """
+    return calc_lattice_sum(
+        crystal=CRYSTAL_KCl_2D,
+        power=6,
+        value_range=value_range,
+        **kwargs,
+    )
 
-    u_ = np.arange(-value_range, value_range+1, dtype=float)
-    v_ = np.arange(-value_range, value_range+1, dtype=float)
-
-    u, v = np.meshgrid(u_, v_, indexing='ij')
-
-    # assert np.all(u[:, 0, 0] == u_)
-    # assert np.all(v[0, :, 0] == v_)
-    # assert np.all(w[0, 0, :] == w_)
 
-    A_1 = 1.0/(u**2 + v**2)**6
-    A_1 = A_1.flatten()
-    A_1[np.isinf(A_1)] = 0.0
-
-    result = np.sum(A_1)
+def calc_LJ_KCl_2D_2(value_range=100, **kwargs):
+    """
+    sum of 1/(u**2 + v**2)**6
 
-    return result
+    :param value_range: half width of the summed square of indices
+    :param kwargs: see calc_lattice_sum
+    :return:
+    """
+    return calc_lattice_sum(
+        crystal=CRYSTAL_SQUARE,
+        power=6,
+        value_range=value_range,
+        **kwargs,
+    )
 
 
-def calc_bond_length_cubic(sigma):
-    A_12 = calc_limit_cubic(power=6, value_range=30)
-    A_6 = calc_limit_cubic(power=3, value_range=30)
+def calc_bond_length_cubic(sigma, tol=None):
+    A_12, A_6 = calc_limit_cubic(power=[6, 3], value_range=30, tol=tol)
     a_0 = (2*A_12/A_6)**(1/6)*sigma
     return a_0
 
 
-def calc_bond_length_FCC(sigma):
-    A_12 = calc_limit_FCC(power=6, value_range=30)
-    A_6 = calc_limit_FCC(power=3, value_range=30)
+def calc_bond_length_FCC(sigma, tol=None):
+    A_12, A_6 = calc_limit_FCC(power=[6, 3], value_range=30, tol=tol)
     # lattice parameter
     a_0 = (2 * A_12 / A_6) ** (1 / 6) * sigma
     # nearest distance
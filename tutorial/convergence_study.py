@@ -0,0 +1,69 @@
+import os
+
+from matplotlib import pyplot as plt
+
+from hw05.hw05_01 import register_lattice_sums as register_hw05
+from tutorial.calc_limit import register_lattice_sums as register_tutorial
+from utils.convergence_utils import (
+    LATTICE_SUMS,
+    format_convergence_table,
+    get_geometric_ranges,
+    plot_convergence,
+    run_convergence_study,
+)
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# relative to this file, the script runs from the repository root
+PLOTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'plots', 'tutorial',
+)
+
+
+def study(name, stop=None, workers=1, save_fig=False, show_fig=False):
+    """
+    print the convergence table of a registered lattice sum and plot
+    its estimated error
+
+    :param name: key of LATTICE_SUMS
+    :param stop: largest value_range, 1000 in 2D and 160 in 3D if None
+    :param workers: number of processes, None for all cores
+    :param save_fig:
+    :param show_fig:
+    :return: rows of run_convergence_study
+    """
+    if stop is None:
+        stop = 1000 if LATTICE_SUMS[name]['dim'] == 2 else 160
+    rows = run_convergence_study(
+        name=name,
+        value_ranges=get_geometric_ranges(start=10, stop=stop),
+        workers=workers,
+    )
+    print(name)
+    print(format_convergence_table(rows))
+    print()
+
+    fig, ax = plot_convergence(rows)
+    ax.set_title(name, size=36)
+    if save_fig:
+        os.makedirs(PLOTS_DIR, exist_ok=True)
+        plt.savefig(
+            os.path.join(PLOTS_DIR, 'convergence_{}.png'.format(name)),
+            dpi=300,
+        )
+    if show_fig:
+        plt.show()
+    plt.close(fig)
+    return rows
+
+
+if __name__ == '__main__':
+
+    register_tutorial()
+    register_hw05()
+    for name in LATTICE_SUMS:
+        study(name)
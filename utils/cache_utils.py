@@ -0,0 +1,288 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# the cache lives in memory only unless LATTICE_CACHE_DIR names a folder
+# for the file store, e.g. ~/.cache/matsci102_lattice_sums
+DEFAULT_CACHE_DIR = os.environ.get('LATTICE_CACHE_DIR') or None
+DEFAULT_MAX_ENTRIES = 256
+# files kept in the store, the least recently used are removed beyond it
+DEFAULT_MAX_FILES = 4096
+# set LATTICE_CACHE to 0 or off to compute every sum, see set_cache_enabled
+CACHE_ENABLED = os.environ.get('LATTICE_CACHE', '1').lower() not in (
+    '0', 'off', 'false', 'no',
+)
+# bump when the meaning of cached values changes without a source change
+CACHE_VERSION = 2
+
+
+def set_cache_enabled(enabled: bool):
+    """
+    switch all cached_lattice_sum functions between cached and
+    recomputed, e.g. while changing a kernel
+
+    :param enabled:
+    :return: the previous setting
+    """
+    global CACHE_ENABLED
+    previous = CACHE_ENABLED
+    CACHE_ENABLED = bool(enabled)
+    return previous
+
+
+def _to_json(value):
+    if isinstance(value, (type, np.dtype)):
+        # e.g. dtype=np.float32
+        return np.dtype(value).name
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    return value
+
+
+def _copy(value):
+    # callers must not be able to modify cached arrays
+    if isinstance(value, tuple):
+        return tuple(_copy(v) for v in value)
+    return value.copy() if isinstance(value, np.ndarray) else value
+
+
+def _encode(value):
+    # JSON with the type, so that a (value, error) tuple or an array
+    # comes back as it was stored
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(v) for v in value]}
+    if isinstance(value, np.ndarray):
+        return {'array': value.tolist(), 'dtype': value.dtype.name}
+    return {'scalar': _to_json(value)}
+
+
+def _decode(data):
+    if 'tuple' in data:
+        return tuple(_decode(v) for v in data['tuple'])
+    if 'array' in data:
+        return np.array(data['array'], dtype=data['dtype'])
+    return data['scalar']
+
+
+def get_source_hash(modules):
+    """
+    hash of the source files of modules, part of every key so that
+    entries computed by older code are not served
+
+    :param modules: module objects or names
+    :return: hex string
+    """
+    digest = hashlib.sha256(str(CACHE_VERSION).encode())
+    for module in modules:
+        if isinstance(module, str):
+            module = sys.modules[module]
+        with open(inspect.getsourcefile(module), 'rb') as fr:
+            digest.update(fr.read())
+    return digest.hexdigest()
+
+
+def make_cache_key(name: str, params: dict, version=''):
+    """
+    hash of the kind of sum, its content and the code version. Arrays
+    are keyed by their values, so equal lattices, bases or exponents
+    share an entry
+
+    :param name: kind of sum, e.g. the kernel function
+    :param params: argument name -> value, JSON serializable after
+        converting numpy arrays and scalars
+    :param version: e.g. get_source_hash of the computing modules
+    :return: hex string
+    """
+    content = json.dumps(
+        [name, version, {k: _to_json(v) for k, v in params.items()}],
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class LatticeSumCache:
+    """
+    results of lattice sums held in memory with LRU eviction and
+    optionally backed by one JSON file per entry, so they survive across
+    processes and reruns. Floats are written with repr, i.e. reloaded
+    bit-exactly.
+    """
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        max_files=DEFAULT_MAX_FILES,
+    ):
+        """
+
+        :param cache_dir: folder of the file store, None or '' to keep
+            the cache in memory only
+        :param max_entries: number of entries kept in memory
+        :param max_files: number of entries kept on disk, the least
+            recently used are removed beyond it
+        """
+        self.cache_dir = cache_dir or None
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self._memory = OrderedDict()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return: the cached value or None
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return _copy(self._memory[key])
+        if self.cache_dir is None:
+            return None
+        path = self._get_path(key)
+        try:
+            with open(path) as fr:
+                value = _decode(json.load(fr))
+            # the modification time orders the files for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self._put_memory(key, value)
+        return _copy(value)
+
+    def put(self, key, value):
+        """
+
+        :param key:
+        :param value: float, array or tuple of those
+        :return:
+        """
+        self._put_memory(key, _copy(value))
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._get_path(key)
+        # write then rename, other processes never see a partial file
+        path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(path_tmp, 'w') as fw:
+            json.dump(_encode(value), fw)
+        os.replace(path_tmp, path)
+        self._evict_files()
+
+    def _evict_files(self):
+        paths = [
+            os.path.join(self.cache_dir, file_name)
+            for file_name in os.listdir(self.cache_dir)
+            if file_name.endswith('.json')
+        ]
+        if len(paths) <= self.max_files:
+            return
+        times = []
+        for path in paths:
+            try:
+                times.append(os.path.getmtime(path))
+            except OSError:
+                # removed by another process
+                times.append(-np.inf)
+        for index in np.argsort(times)[:len(paths)-self.max_files]:
+            try:
+                os.remove(paths[index])
+            except OSError:
+                pass
+
+    def _put_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """
+        drop all entries, in memory and on disk
+
+        :return:
+        """
+        self._memory.clear()
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.json'):
+                os.remove(os.path.join(self.cache_dir, file_name))
+
+
+DEFAULT_CACHE = LatticeSumCache()
+
+
+def cached_lattice_sum(
+    func=None,
+    cache=None,
+    ignore=('block_size', 'workers'),
+    canonicalize=None,
+    depends=(),
+):
+    """
+    decorator caching the result of a lattice sum keyed by the content
+    of the sum, i.e. the function and all its bound arguments with
+    defaults, after canonicalize, and by the source of the function's
+    module and depends. Put it on the shared kernels, so the same sum
+    reached from different scripts shares an entry.
+
+    :param func:
+    :param cache: LatticeSumCache, DEFAULT_CACHE if None
+    :param ignore: arguments that do not change the result
+    :param canonicalize: maps the dict of arguments to JSON serializable
+        content, e.g. a crystal to its lattice, basis and charges
+    :param depends: modules whose source the result depends on
+    :return:
+    """
+    if func is None:
+        return functools.partial(
+            cached_lattice_sum,
+            cache=cache,
+            ignore=ignore,
+            canonicalize=canonicalize,
+            depends=depends,
+        )
+    signature = inspect.signature(func)
+    name = '{}.{}'.format(func.__module__, func.__qualname__)
+    version = get_source_hash((func.__module__, ) + tuple(depends))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not CACHE_ENABLED:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = {
+            k: v for k, v in bound.arguments.items() if k not in ignore
+        }
+        if canonicalize is not None:
+            params = canonicalize(params)
+        key = make_cache_key(name, params, version)
+        store = cache if cache is not None else DEFAULT_CACHE
+        value = store.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            store.put(key, value)
+        return value
+
+    return wrapper
@@ -0,0 +1,192 @@
+import time
+
+import numpy as np
+
+from utils.lattice_sum_utils import DEFAULT_BLOCK_SIZE, LatticeSum
+from utils.plot_utils import fig_from_fig_or_none
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# name -> dict(term_func, dim, exponent, conditional), see
+# register_lattice_sum
+LATTICE_SUMS = {}
+
+
+def register_lattice_sum(
+    name: str,
+    term_func,
+    dim: int,
+    exponent=None,
+    conditional=False,
+):
+    """
+    make a lattice sum available to run_convergence_study by name
+
+    :param name:
+    :param term_func: maps an (n_points, dim) index array to terms,
+        picklable if the study uses workers
+    :param dim:
+    :param exponent: float or array like the sum, the terms outside the
+        cube of value_range N add up to O(N^-exponent), e.g. 2*power - dim
+        for 1/r^(2*power). None if unknown
+    :param conditional: the sum is only conditionally convergent, e.g. a
+        direct Madelung sum. Its cubes tend to a shape dependent value,
+        so the study reports no extrapolation and no error for it
+    :return:
+    """
+    LATTICE_SUMS[name] = dict(
+        term_func=term_func,
+        dim=dim,
+        exponent=exponent,
+        conditional=conditional,
+    )
+
+
+def get_geometric_ranges(start=10, stop=1000, ratio=2.0):
+    """
+    value ranges start, start*ratio, start*ratio^2, ... rounded to
+    integers, and stop
+
+    :param start:
+    :param stop:
+    :param ratio:
+    :return: list of increasing int
+    """
+    num_steps = int(np.floor(np.log(stop/start)/np.log(ratio) + 1e-9))
+    ranges = np.round(start*ratio**np.arange(num_steps+1)).astype(int)
+    return sorted(set(ranges.tolist()) | {stop})
+
+
+def run_convergence_study(
+    name: str,
+    value_ranges=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+):
+    """
+    the registered lattice sum over the cubes of increasing value_ranges.
+    Each step adds only the points between the previous cube and the
+    new one. With a known exponent the error is estimated by Richardson
+    extrapolation of the last two steps at the effective radii N + 1/2,
+    else by the change of the last step. Conditionally convergent sums
+    get nan for both, their change says nothing about the bulk value.
+
+    :param name: key of LATTICE_SUMS
+    :param value_ranges: increasing, get_geometric_ranges() if None
+    :param block_size: number of lattice points evaluated at once
+    :param workers: number of processes, None for all cores
+    :return: list of one dict per step with value_range, value,
+        extrapolated, error, time, num_points and conditional
+    """
+    registered = LATTICE_SUMS[name]
+    if value_ranges is None:
+        value_ranges = get_geometric_ranges()
+    exponent = registered['exponent']
+    conditional = registered['conditional']
+    lattice_sum = LatticeSum(
+        term_func=registered['term_func'],
+        dim=registered['dim'],
+        block_size=block_size,
+        workers=workers,
+    )
+
+    previous_range = -1
+    previous_value = None
+    rows = []
+    for value_range in value_ranges:
+        start = time.perf_counter()
+        value = lattice_sum.extend(to=value_range)
+        elapsed = time.perf_counter() - start
+
+        extrapolated = value
+        error = np.full(np.shape(value), np.nan)
+        if conditional:
+            extrapolated = np.full(np.shape(value), np.nan)
+        elif previous_value is not None:
+            change = value - previous_value
+            if exponent is not None:
+                ratio = (value_range + 0.5)/(previous_range + 0.5)
+                change = change/(ratio**np.asarray(exponent) - 1.0)
+                extrapolated = value + change
+            error = np.abs(change)
+        rows.append({
+            'value_range': value_range,
+            'value': value,
+            'extrapolated': extrapolated,
+            'error': error,
+            'time': elapsed,
+            'num_points': lattice_sum.num_points,
+            'conditional': conditional,
+        })
+        previous_range = value_range
+        previous_value = value
+    return rows
+
+
+def format_convergence_table(rows):
+    """
+    one line per step of run_convergence_study, one column group per
+    component of an array valued sum. Conditionally convergent sums
+    are flagged in a first line
+
+    :param rows:
+    :return: str
+    """
+    lines = []
+    if rows and rows[0]['conditional']:
+        lines.append(
+            'conditionally convergent: the values depend on the shape of '
+            'the summed cube and do not converge to the bulk value'
+        )
+    lines += ['{:>8s} {:>12s} {:>24s} {:>24s} {:>10s} {:>10s}'.format(
+        'N', 'points', 'value', 'extrapolated', 'error', 'time (s)',
+    )]
+    for row in rows:
+        for k, (value, extrapolated, error) in enumerate(zip(
+            np.ravel(row['value']),
+            np.ravel(row['extrapolated']),
+            np.ravel(row['error']),
+        )):
+            lines.append(
+                '{:>8s} {:>12s} {:24.16e} {:24.16e} {:10.2e} {:>10s}'.format(
+                    str(row['value_range']) if k == 0 else '',
+                    str(row['num_points']) if k == 0 else '',
+                    value,
+                    extrapolated,
+                    error,
+                    '{:.4f}'.format(row['time']) if k == 0 else '',
+                )
+            )
+    return '\n'.join(lines)
+
+
+def plot_convergence(
+    rows,
+    fig=None,
+    ax=None,
+    **kwargs,
+):
+    """
+    estimated error against value_range on log-log axes
+
+    :param rows: from run_convergence_study
+    :param fig:
+    :param ax:
+    :param kwargs: passed to ax.plot
+    :return: fig, ax
+    """
+    fig, ax = fig_from_fig_or_none(fig=fig, ax=ax)
+    value_ranges = [row['value_range'] for row in rows[1:]]
+    errors = np.array([np.ravel(row['error']) for row in rows[1:]])
+    ax.plot(value_ranges, errors, marker='o', **kwargs)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('value range N', size=36)
+    ax.set_ylabel('estimated error', size=36)
+    ax.tick_params(axis='x', which='major', labelsize=32)
+    ax.tick_params(axis='y', which='major', labelsize=32)
+    return fig, ax
@@ -0,0 +1,394 @@
+from functools import partial
+
+import numpy as np
+
+from utils import lattice_jit_utils, lattice_sum_utils
+from utils.cache_utils import cached_lattice_sum
+from utils.ewald_utils import calc_Madelung_ewald_2D, calc_Madelung_ewald_3D
+from utils.lattice_jit_utils import sum_lattice_loop, use_numba
+from utils.lattice_sum_utils import (
+    DEFAULT_BLOCK_SIZE,
+    sum_lattice,
+    sum_lattice_extrapolated,
+    sum_lattice_shells,
+    sum_lattice_symmetric,
+    term_alternating,
+    term_inverse_power,
+    term_sublattices,
+)
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+class Crystal:
+    """
+    periodic crystal in 2D or 3D: Bravais lattice plus a basis of sites
+    """
+    def __init__(
+        self,
+        lattice,
+        basis,
+        charges=None,
+        species=None,
+    ):
+        """
+
+        :param lattice: (dim, dim) array, lattice vectors as rows
+        :param basis: (n_sites, dim) fractional coordinates
+        :param charges: (n_sites, ) charges, zero if None
+        :param species: (n_sites, ) labels, e.g. ['Na', 'Cl']
+        """
+        self.lattice = np.asarray(lattice, dtype=float)
+        self.basis = np.atleast_2d(np.asarray(basis, dtype=float))
+        if charges is None:
+            charges = np.zeros(len(self.basis))
+        self.charges = np.asarray(charges, dtype=float)
+        self.species = list(species) if species is not None else None
+        if self.lattice.shape != (self.dim, self.dim):
+            raise ValueError('lattice must be a square matrix')
+        if self.basis.shape[-1] != self.dim:
+            raise ValueError('basis and lattice dimensions differ')
+        if len(self.charges) != self.num_sites:
+            raise ValueError('basis and charges must have the same length')
+        if self.species is not None and len(self.species) != self.num_sites:
+            raise ValueError('basis and species must have the same length')
+
+    @property
+    def dim(self):
+        return len(self.lattice)
+
+    @property
+    def num_sites(self):
+        return len(self.basis)
+
+    @property
+    def volume(self):
+        return abs(np.linalg.det(self.lattice))
+
+    @property
+    def positions(self):
+        """
+        Cartesian positions of the basis sites, (n_sites, dim)
+        """
+        return self.basis@self.lattice
+
+    def get_site_shifts(self, site_index=0):
+        """
+        Cartesian vectors from site site_index to every basis site
+
+        :param site_index:
+        :return: (n_sites, dim) array
+        """
+        positions = self.positions
+        return positions - positions[site_index]
+
+
+# modules whose source the cached sums depend on
+_KERNEL_MODULES = (lattice_jit_utils, lattice_sum_utils)
+
+
+def _canonicalize_crystal(crystal: Crystal):
+    # species and the Python object do not change a sum
+    return {
+        'lattice': crystal.lattice,
+        'basis': crystal.basis,
+        'charges': crystal.charges,
+    }
+
+
+def _canonicalize_lattice_sum(params):
+    params = dict(params)
+    crystal = params.pop('crystal')
+    params['crystal'] = _canonicalize_crystal(crystal)
+    if params['weights'] is None:
+        params['weights'] = np.ones(crystal.num_sites)
+    params['power'] = np.asarray(params['power'], dtype=float)
+    if params['tol'] is not None:
+        # the shells stop at tol, value_range is not used
+        params['value_range'] = None
+    return params
+
+
+def _get_summed_sites(crystal: Crystal, weights, site_index: int):
+    if weights is None:
+        weights = np.ones(crystal.num_sites)
+    weights = np.asarray(weights, dtype=float)
+    shifts = crystal.get_site_shifts(site_index)
+    return shifts[weights != 0.0], weights[weights != 0.0]
+
+
+def get_term_func(
+    crystal: Crystal,
+    power,
+    weights=None,
+    site_index=0,
+):
+    """
+    term function of sum_j weights_j * sum_n' 1/|n @ L + r_j - r_i|^(2*power)
+    for the lattice-sum kernels of utils.lattice_sum_utils.
+    Sites with zero weight are skipped.
+
+    :param crystal:
+    :param power: float or (n_powers, ) array
+    :param weights: (n_sites, ) weights, all ones if None
+    :param site_index: index of the reference site i
+    :return:
+    """
+    shifts, weights = _get_summed_sites(crystal, weights, site_index)
+    if len(weights) == 1 and weights[0] == 1.0:
+        # a plain Bravais lattice, possibly shifted
+        return partial(
+            term_inverse_power,
+            lattice=crystal.lattice,
+            power=power,
+            shift=shifts[0] if np.any(shifts[0] != 0.0) else None,
+        )
+    return partial(
+        term_sublattices,
+        lattice=crystal.lattice,
+        power=power,
+        shifts=shifts,
+        weights=weights,
+    )
+
+
+@cached_lattice_sum(
+    canonicalize=_canonicalize_lattice_sum,
+    depends=_KERNEL_MODULES,
+)
+def calc_lattice_sum(
+    crystal: Crystal,
+    power,
+    weights=None,
+    site_index=0,
+    value_range=100,
+    tol=None,
+    symmetry=None,
+    extrapolation=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    reduction='pairwise',
+    return_error=False,
+    backend='numpy',
+):
+    """
+    sum_j weights_j * sum_n' 1/|n @ L + r_j - r_i|^(2*power), the terms
+    with r = 0 are left out
+
+    :param crystal:
+    :param power: float or (n_powers, ) array, the sums of an array of
+        powers come from one pass over the lattice
+    :param weights: (n_sites, ) weights, all ones if None
+    :param site_index: index of the reference site i
+    :param value_range: half width of the summed cube of indices
+    :param tol: if given, sum spherical shells until the estimated tail
+        is below tol relative to the sum instead of using value_range
+    :param symmetry: if given, sum only the irreducible wedge of the cube
+        of indices, see iter_wedge_blocks. The summed sites must be
+        invariant under the group
+    :param extrapolation: None, 'tail' or 'richardson', account for the
+        terms outside value_range, see sum_lattice_extrapolated
+    :param block_size: number of lattice points evaluated at once
+    :param workers: number of processes, None for all cores.
+        Results do not depend on it, not used with tol
+    :param reduction: 'pairwise', 'compensated' or 'exact' summation of
+        the terms, see reduce_terms. Only for plain and symmetric sums
+    :param return_error: also return the bound of the rounding error.
+        Only for plain and symmetric sums
+    :param backend: 'numpy' or 'numba', the compiled loop of
+        sum_lattice_loop, only for plain sums
+    :return: sum[, error]
+    """
+    if (reduction != 'pairwise' or return_error) and (
+        tol is not None or extrapolation is not None
+    ):
+        raise ValueError(
+            'reduction and return_error need a plain or symmetric sum'
+        )
+    if use_numba(backend, plain=(
+        tol is None and symmetry is None and extrapolation is None
+        and reduction == 'pairwise' and not return_error
+    )):
+        shifts, site_weights = _get_summed_sites(
+            crystal, weights, site_index,
+        )
+        return sum_lattice_loop(
+            lattice=crystal.lattice,
+            power=power,
+            value_range=value_range,
+            shifts=shifts,
+            weights=site_weights,
+            block_size=block_size,
+            workers=workers,
+        )
+    term_func = get_term_func(
+        crystal=crystal,
+        power=power,
+        weights=weights,
+        site_index=site_index,
+    )
+    if tol is not None:
+        _, site_weights = _get_summed_sites(crystal, weights, site_index)
+        return sum_lattice_shells(
+            term_func=term_func,
+            lattice=crystal.lattice,
+            tol=tol,
+            power=power,
+            # bounds the tail of mixed signs as well
+            weight=np.sum(np.abs(site_weights)),
+            block_size=block_size,
+        )
+    block_size = max(block_size//np.size(power), 1)
+    if extrapolation is not None:
+        shifts, site_weights = _get_summed_sites(
+            crystal, weights, site_index,
+        )
+        return sum_lattice_extrapolated(
+            term_func=term_func,
+            lattice=crystal.lattice,
+            value_range=value_range,
+            power=power,
+            method=extrapolation,
+            weight=np.sum(site_weights),
+            # centre the 'tail' sphere on a single summed sublattice
+            shift=shifts[0] if len(shifts) == 1 else None,
+            symmetry=symmetry,
+            block_size=block_size,
+            workers=workers,
+        )
+    if symmetry is not None:
+        return sum_lattice_symmetric(
+            term_func=term_func,
+            value_range=value_range,
+            dim=crystal.dim,
+            symmetry=symmetry,
+            workers=workers,
+            reduction=reduction,
+            return_error=return_error,
+        )
+    return sum_lattice(
+        term_func=term_func,
+        value_range=value_range,
+        dim=crystal.dim,
+        block_size=block_size,
+        workers=workers,
+        reduction=reduction,
+        return_error=return_error,
+    )
+
+
+def calc_Madelung(
+    crystal: Crystal,
+    site_index=0,
+    value_range=100,
+    method='direct',
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    reduction='pairwise',
+    return_error=False,
+    backend='numpy',
+):
+    """
+    q_i * sum_j' q_j/r_ij in the length unit of the lattice vectors.
+    The direct sum over a cube of cells is only conditionally
+    convergent, so it converges slowly and to a shape dependent value.
+    Use method='ewald' for the converged Madelung constant.
+
+    :param crystal: needs charges summing to zero for 'ewald'
+    :param site_index: index of the reference site i
+    :param value_range: half width of the summed cube of indices
+    :param method: 'direct' or 'ewald'. value_range is ignored for 'ewald'
+    :param block_size: number of lattice points evaluated at once
+    :param workers: number of processes, None for all cores
+    :param reduction: 'pairwise', 'compensated' or 'exact' summation of
+        the direct sum, see reduce_terms
+    :param return_error: also return the bound of the rounding error,
+        zero for 'ewald'
+    :param backend: 'numpy' or 'numba' for the direct sum,
+        see calc_lattice_sum
+    :return: Madelung sum[, error]
+    """
+    # the direct sum is cached by calc_lattice_sum, Ewald is fast
+    if method == 'ewald':
+        calc_ewald = {
+            2: calc_Madelung_ewald_2D,
+            3: calc_Madelung_ewald_3D,
+        }[crystal.dim]
+        result = calc_ewald(
+            lattice=crystal.lattice,
+            basis=crystal.basis,
+            charges=crystal.charges,
+            site_index=site_index,
+        )
+        if return_error:
+            return result, 0.0
+        return result
+    if method != 'direct':
+        raise ValueError('unknown method {}'.format(method))
+    return calc_lattice_sum(
+        crystal=crystal,
+        power=0.5,
+        weights=crystal.charges[site_index]*crystal.charges,
+        site_index=site_index,
+        value_range=value_range,
+        block_size=block_size,
+        workers=workers,
+        reduction=reduction,
+        return_error=return_error,
+        backend=backend,
+    )
+
+
+@cached_lattice_sum(depends=_KERNEL_MODULES)
+def calc_alternating_sum(
+    lattice,
+    power,
+    value_range=100,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    reduction='pairwise',
+    return_error=False,
+    backend='numpy',
+):
+    """
+    sum_n' (-1)^(n_1+...+n_dim)/|n @ L|^(2*power) over the cube of
+    indices, e.g. the direct Madelung sum of a rock-salt layer on the
+    square of (u, v). Only conditionally convergent for power 0.5
+
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :param power: float or (n_powers, ) array
+    :param value_range: half width of the summed cube of indices
+    :param block_size: number of lattice points evaluated at once
+    :param workers: number of processes, None for all cores
+    :param reduction: 'pairwise', 'compensated' or 'exact' summation of
+        the terms, see reduce_terms
+    :param return_error: also return the bound of the rounding error
+    :param backend: 'numpy' or 'numba', see calc_lattice_sum
+    :return: sum[, error]
+    """
+    lattice = np.asarray(lattice, dtype=float)
+    if use_numba(backend, plain=reduction == 'pairwise' and not return_error):
+        return sum_lattice_loop(
+            lattice=lattice,
+            power=power,
+            value_range=value_range,
+            alternating=True,
+            block_size=block_size,
+            workers=workers,
+        )
+    return sum_lattice(
+        term_func=partial(
+            term_alternating,
+            lattice=lattice,
+            power=power,
+        ),
+        value_range=value_range,
+        dim=len(lattice),
+        block_size=block_size,
+        workers=workers,
+        reduction=reduction,
+        return_error=return_error,
+    )
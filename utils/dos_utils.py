@@ -0,0 +1,410 @@
+import numpy as np
+
+from utils.constants import eV_to_J, hbar, k_B, m_e
+from utils.kronig_penney_utils import calc_band_structure
+from utils.math_utils import bisect_elementwise
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# volume of the unit ball in dim dimensions
+UNIT_BALL_VOLUMES = {1: 2.0, 2: np.pi, 3: 4.0*np.pi/3.0}
+# -df/dE is cut where it is below exp(-FERMI_WINDOW) of its peak,
+# in units of k_B*T
+FERMI_WINDOW = 40.0
+
+
+def _check_dim(dim):
+    if dim not in UNIT_BALL_VOLUMES:
+        raise ValueError('dim must be 1, 2 or 3, got {}'.format(dim))
+
+
+def _calc_fermi_peak(u):
+    """
+    -df/du of the Fermi-Dirac distribution at u = (E - mu)/(k_B*T),
+    written so that it does not overflow for large |u|
+    """
+    x = np.exp(-np.abs(u))
+    return x/(1.0 + x)**2
+
+
+def calc_fermi_dirac(E, mu, T):
+    """
+    occupation of a state, a step at T = 0
+
+    :param E: unit J
+    :param mu: chemical potential, unit J
+    :param T: unit K
+    :return: array of the broadcast shape
+    """
+    E, mu, T = np.broadcast_arrays(*(
+        np.asarray(x, dtype=float) for x in (E, mu, T)
+    ))
+    kT = np.where(T > 0, k_B*T, 1.0)
+    occupation = 0.5*(1.0 - np.tanh((E - mu)/kT/2))
+    step = np.where(E < mu, 1.0, np.where(E == mu, 0.5, 0.0))
+    return np.where(T > 0, occupation, step)
+
+
+def _get_free_electron_coefficient(dim, m, spin):
+    # N(E) = coefficient*E^(dim/2)
+    _check_dim(dim)
+    return spin*UNIT_BALL_VOLUMES[dim]*(2*m)**(dim/2)/(2*np.pi*hbar)**dim
+
+
+def calc_free_electron_states(E, dim, m=m_e, spin=2):
+    """
+    number of states below E per unit length, area or volume,
+    0 for E <= 0
+
+    :param E: unit J
+    :param dim: 1, 2 or 3
+    :param m: unit kg
+    :param spin: degeneracy of every k
+    :return: unit 1/m^dim
+    """
+    E = np.maximum(np.asarray(E, dtype=float), 0.0)
+    return _get_free_electron_coefficient(dim, m, spin)*E**(dim/2)
+
+
+def calc_free_electron_dos(E, dim, m=m_e, spin=2):
+    """
+    density of states per unit length, area or volume, 0 for E <= 0.
+    It diverges as E^(-1/2) at E = 0 in 1D.
+
+    :param E: unit J
+    :param dim: 1, 2 or 3
+    :param m: unit kg
+    :param spin: degeneracy of every k
+    :return: unit 1/(J m^dim)
+    """
+    E = np.asarray(E, dtype=float)
+    coefficient = _get_free_electron_coefficient(dim, m, spin)
+    with np.errstate(divide='ignore'):
+        dos = dim/2*coefficient*np.maximum(E, 0.0)**(dim/2 - 1)
+    return np.where(E > 0, dos, 0.0)
+
+
+def calc_free_electron_fermi(n, dim, m=m_e, spin=2):
+    """
+    Fermi wave vector, energy, velocity and temperature of a free
+    electron gas at T = 0
+
+    :param n: electron density, unit 1/m^dim, float or array
+    :param dim: 1, 2 or 3
+    :param m: unit kg
+    :param spin: degeneracy of every k
+    :return: dict of k_F (1/m), E_F (J), v_F (m/s) and T_F (K)
+    """
+    _check_dim(dim)
+    n = np.asarray(n, dtype=float)
+    k_F = 2*np.pi*(n/spin/UNIT_BALL_VOLUMES[dim])**(1/dim)
+    E_F = (hbar*k_F)**2/2/m
+    return {
+        'k_F': k_F,
+        'E_F': E_F,
+        'v_F': hbar*k_F/m,
+        'T_F': E_F/k_B,
+    }
+
+
+def calc_free_electron_density(mu, T, dim, m=m_e, spin=2, num_nodes=256):
+    """
+    electron density of a free electron gas at chemical potential mu
+    and temperature T, the integral of N(E)*(-df/dE).
+    In 2D it is analytic. In 1D and 3D the substitution
+    E = k_B*T*s^2 makes the integrand smooth and even in s, so the
+    trapezoidal rule on num_nodes points of the window where -df/dE
+    matters converges exponentially, also for mu >> k_B*T.
+
+    :param mu: unit J
+    :param T: unit K
+    :param dim: 1, 2 or 3
+    :param m: unit kg
+    :param spin: degeneracy of every k
+    :param num_nodes: of the trapezoidal rule
+    :return: unit 1/m^dim, array of the broadcast shape of mu and T
+    """
+    coefficient = _get_free_electron_coefficient(dim, m, spin)
+    mu, T = np.broadcast_arrays(
+        np.asarray(mu, dtype=float), np.asarray(T, dtype=float),
+    )
+    kT = np.where(T > 0, k_B*T, 1.0)
+    eta = mu/kT
+    if dim == 2:
+        density = coefficient*kT*np.logaddexp(0.0, eta)
+    else:
+        s_low = np.sqrt(np.maximum(eta - FERMI_WINDOW, 0.0))
+        s_high = np.sqrt(np.maximum(eta, 0.0) + FERMI_WINDOW)
+        t = np.linspace(0.0, 1.0, num_nodes)
+        s = s_low[..., None] + (s_high - s_low)[..., None]*t
+        integrand = 2*s**(dim + 1)*_calc_fermi_peak(s**2 - eta[..., None])
+        integral = (
+            np.sum(integrand, axis=-1)
+            - (integrand[..., 0] + integrand[..., -1])/2
+        )*(s_high - s_low)/(num_nodes - 1)
+        density = coefficient*kT**(dim/2)*integral
+    return np.where(
+        T > 0, density, calc_free_electron_states(mu, dim, m, spin),
+    )
+
+
+def find_fermi_level(n, T, calc_density, low, high, xtol=1e-12*eV_to_J):
+    """
+    chemical potential mu with calc_density(mu, T) = n by bisection over
+    all elements of n and T at once. The bracket [low, high] is widened
+    elementwise until it contains mu.
+
+    :param n: electron density, float or array
+    :param T: unit K, float or array
+    :param calc_density: vectorized (mu, T) -> density, increasing in mu
+    :param low: initial lower bound of mu, unit J, float or array
+    :param high: initial upper bound of mu, unit J, float or array
+    :param xtol: absolute tolerance of mu, unit J
+    :return: mu, unit J, array of the broadcast shape of n and T
+    """
+    n, T, low, high = (
+        np.array(x, dtype=float)
+        for x in np.broadcast_arrays(n, T, low, high)
+    )
+    for _ in range(64):
+        below = calc_density(low, T) > n
+        above = calc_density(high, T) < n
+        if not (below.any() or above.any()):
+            break
+        width = high - low
+        low = np.where(below, low - width, low)
+        high = np.where(above, high + width, high)
+    else:
+        raise ValueError('could not bracket the Fermi level')
+
+    return bisect_elementwise(
+        lambda mu: calc_density(mu, T) - n, low, high, xtol, -1.0,
+    )
+
+
+def find_free_electron_fermi_level(
+    n,
+    T,
+    dim,
+    m=m_e,
+    spin=2,
+    xtol=1e-12*eV_to_J,
+):
+    """
+    chemical potential of a free electron gas, e.g. over a whole (n, T)
+    map given as n[:, None] and T[None, :]
+
+    :param n: electron density, unit 1/m^dim, float or array
+    :param T: unit K, float or array
+    :param dim: 1, 2 or 3
+    :param m: unit kg
+    :param spin: degeneracy of every k
+    :param xtol: absolute tolerance, unit J
+    :return: mu, unit J, array of the broadcast shape of n and T
+    """
+    E_F = calc_free_electron_fermi(n, dim, m, spin)['E_F']
+    width = E_F + 10*k_B*np.asarray(T, dtype=float)
+    return find_fermi_level(
+        n, T,
+        lambda mu, T: calc_free_electron_density(mu, T, dim, m, spin),
+        low=E_F - width,
+        high=E_F + width,
+        xtol=xtol,
+    )
+
+
+def calc_dos_histogram(bands, E_edges, states_per_band=1.0):
+    """
+    density of states as a histogram of band energies sampled uniformly
+    in k, e.g. at the midpoints of the intervals of k
+
+    :param bands: (..., n_k) energies, one row per band, unit J
+    :param E_edges: (n_bins + 1, ) increasing bin edges, unit J
+    :param states_per_band: number of states of one band, e.g. per unit
+        length
+    :return: (n_bins, ) states per unit energy
+    """
+    bands = np.asarray(bands, dtype=float)
+    E_edges = np.asarray(E_edges, dtype=float)
+    counts, _ = np.histogram(bands, bins=E_edges)
+    return counts*states_per_band/bands.shape[-1]/np.diff(E_edges)
+
+
+def calc_states_tetrahedron(bands, E, states_per_band=1.0):
+    """
+    number of states below E with every band linear between successive
+    k points, the 1D version of the linear tetrahedron method.
+    Exact for the piecewise linear bands, so unlike the histogram it
+    has no noise from the sampling.
+
+    :param bands: (..., n_k) energies at increasing, uniform k
+        including both ends of the range, unit J
+    :param E: unit J, float or array
+    :param states_per_band: number of states of one band, e.g. per unit
+        length
+    :return: array of the shape of E
+    """
+    bands = np.asarray(bands, dtype=float)
+    E = np.asarray(E, dtype=float)
+    low = np.minimum(bands[..., :-1], bands[..., 1:]).ravel()
+    high = np.maximum(bands[..., :-1], bands[..., 1:]).ravel()
+    width = high - low
+    flat = width == 0
+    # sum of clip((E - low)/width, 0, 1) over the intervals, as the
+    # ramps starting at low minus the ramps starting at high
+    count = np.searchsorted(np.sort(low[flat]), E, side='right').astype(float)
+    for start, sign in ((low[~flat], 1.0), (high[~flat], -1.0)):
+        order = np.argsort(start)
+        inverse_width = 1.0/width[~flat][order]
+        cumulative_inverse = np.concatenate([[0.0], np.cumsum(inverse_width)])
+        cumulative_start = np.concatenate(
+            [[0.0], np.cumsum(start[order]*inverse_width)],
+        )
+        index = np.searchsorted(start[order], E, side='left')
+        count += sign*(E*cumulative_inverse[index] - cumulative_start[index])
+    return count*states_per_band/(bands.shape[-1] - 1)
+
+
+def calc_dos_tetrahedron(bands, E_edges, states_per_band=1.0):
+    """
+    density of states averaged over every bin, from
+    calc_states_tetrahedron
+
+    :param bands: (..., n_k) energies at increasing, uniform k
+        including both ends of the range, unit J
+    :param E_edges: (n_bins + 1, ) increasing bin edges, unit J
+    :param states_per_band: number of states of one band
+    :return: (n_bins, ) states per unit energy
+    """
+    E_edges = np.asarray(E_edges, dtype=float)
+    states = calc_states_tetrahedron(bands, E_edges, states_per_band)
+    return np.diff(states)/np.diff(E_edges)
+
+
+def calc_tabulated_density(mu, T, E, states, num_nodes=641):
+    """
+    electron density at chemical potential mu and temperature T from a
+    tabulated number of states, the integral of N(E)*(-df/dE) by the
+    trapezoidal rule over mu +- FERMI_WINDOW*k_B*T. N is interpolated
+    linearly and taken constant beyond E, so E has to reach above every
+    mu by that window.
+
+    :param mu: unit J
+    :param T: unit K
+    :param E: (n_E, ) increasing, unit J
+    :param states: (n_E, ) number of states below E, e.g. from
+        calc_states_tetrahedron or calc_free_electron_states
+    :param num_nodes: of the trapezoidal rule
+    :return: array of the broadcast shape of mu and T
+    """
+    mu, T = np.broadcast_arrays(
+        np.asarray(mu, dtype=float), np.asarray(T, dtype=float),
+    )
+    u = np.linspace(-FERMI_WINDOW, FERMI_WINDOW, num_nodes)
+    weights = _calc_fermi_peak(u)*(u[1] - u[0])
+    energies = mu[..., None] + k_B*T[..., None]*u
+    density = np.interp(energies, E, states) @ weights
+    return np.where(T > 0, density, np.interp(mu, E, states))
+
+
+def find_tabulated_fermi_level(n, T, E, states, xtol=1e-12*eV_to_J):
+    """
+    chemical potential for a tabulated number of states, e.g. of the
+    Kronig-Penney bands. If n falls in a gap, the density is the same
+    for every mu of a range and mu is the middle of it: at T = 0 the
+    middle of the gap, at T > 0 the middle of the gap narrowed by
+    FERMI_WINDOW*k_B*T at both ends, as long as that is left of it,
+    since calc_tabulated_density cuts the tails of the Fermi-Dirac
+    distribution there.
+
+    :param n: electron density, float or array
+    :param T: unit K, float or array
+    :param E: (n_E, ) increasing, unit J
+    :param states: (n_E, ) number of states below E
+    :param xtol: absolute tolerance, unit J
+    :return: mu, unit J, array of the broadcast shape of n and T
+    """
+    if np.max(n) >= states[-1]:
+        raise ValueError('n reaches the top of the tabulated states')
+
+    def calc_density(mu, T):
+        return calc_tabulated_density(mu, T, E, states)
+
+    mu = find_fermi_level(
+        n, T, calc_density, low=E[0], high=E[-1], xtol=xtol,
+    )
+    n, T = np.broadcast_arrays(
+        np.asarray(n, dtype=float), np.asarray(T, dtype=float),
+    )
+    # on a plateau the density differs from n by rounding only
+    rtol = 64*np.finfo(float).eps*np.abs(n)
+    low = bisect_elementwise(
+        lambda x: np.where(calc_density(x, T) < n - rtol, -1.0, 1.0),
+        np.minimum(E[0], mu), mu, xtol, -1.0,
+    )
+    high = bisect_elementwise(
+        lambda x: np.where(calc_density(x, T) > n + rtol, 1.0, -1.0),
+        mu, np.maximum(E[-1], mu), xtol, -1.0,
+    )
+    return (low + high)/2
+
+
+def get_KP_bands(a, b, V_0, num_bands, num_k=256, midpoints=False):
+    """
+    Kronig-Penney bands on a uniform grid of k in [0, pi/(a+b)], which
+    by E(-k) = E(k) is enough for the density of states
+
+    :param a: unit m
+    :param b: unit m
+    :param V_0: unit J
+    :param num_bands:
+    :param num_k:
+    :param midpoints: the midpoints of num_k intervals of k as for
+        calc_dos_histogram, else num_k points including both ends as
+        for calc_states_tetrahedron
+    :return: (num_bands, num_k) energies, unit J, and the number of
+        states of one band per unit length with spin
+    """
+    k_max = np.pi/(a + b)
+    if midpoints:
+        k = (np.arange(num_k) + 0.5)*k_max/num_k
+    else:
+        k = np.linspace(0.0, k_max, num_k)
+    bands = calc_band_structure(k, a, b, V_0, num_bands)
+    return bands, 2/(a + b)
+
+
+def calc_KP_dos(
+    E_edges,
+    a,
+    b,
+    V_0,
+    num_bands,
+    num_k=256,
+    method='tetrahedron',
+):
+    """
+    density of states of the first num_bands Kronig-Penney bands per
+    unit length with spin
+
+    :param E_edges: (n_bins + 1, ) increasing bin edges, unit J
+    :param a: unit m
+    :param b: unit m
+    :param V_0: unit J
+    :param num_bands: enough to cover E_edges
+    :param num_k:
+    :param method: 'tetrahedron' or 'histogram'
+    :return: (n_bins, ) unit 1/(J m)
+    """
+    if method not in ('tetrahedron', 'histogram'):
+        raise ValueError('unknown method {}'.format(method))
+    bands, states_per_band = get_KP_bands(
+        a, b, V_0, num_bands, num_k, midpoints=method == 'histogram',
+    )
+    if method == 'histogram':
+        return calc_dos_histogram(bands, E_edges, states_per_band)
+    return calc_dos_tetrahedron(bands, E_edges, states_per_band)
@@ -0,0 +1,167 @@
+import numpy as np
+from scipy.special import erfc
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+def get_lattice_vectors_in_sphere(
+    lattice: np.ndarray,
+    radius: float,
+):
+    """
+    all lattice vectors n @ lattice with |n @ lattice| <= radius
+
+    :param lattice: (d, d) array, one lattice vector per row
+    :param radius:
+    :return: (n_vectors, d) array
+    """
+    # distance between neighbouring lattice planes is 1/|row of inv(L).T|
+    plane_normals = np.linalg.inv(lattice).T
+    n_max = np.ceil(
+        radius*np.linalg.norm(plane_normals, axis=1)
+    ).astype(int)
+    mesh = np.meshgrid(
+        *[np.arange(-n, n+1) for n in n_max],
+        indexing='ij',
+    )
+    indices = np.stack([m.flatten() for m in mesh], axis=-1)
+    vectors = indices@lattice
+    vectors = vectors[np.linalg.norm(vectors, axis=1) <= radius]
+    return vectors
+
+
+def _check_ewald_input(lattice, basis, charges):
+    lattice = np.asarray(lattice, dtype=float)
+    basis = np.atleast_2d(np.asarray(basis, dtype=float))
+    charges = np.asarray(charges, dtype=float)
+    if len(basis) != len(charges):
+        raise ValueError(
+            'basis and charges must have the same length'
+        )
+    if abs(np.sum(charges)) > 1e-12*np.sum(np.abs(charges)):
+        raise ValueError(
+            'Ewald summation requires a charge-neutral cell'
+        )
+    return lattice, basis, charges
+
+
+def calc_Madelung_ewald_3D(
+    lattice: np.ndarray,
+    basis: np.ndarray,
+    charges: np.ndarray,
+    site_index=0,
+    accuracy=1e-16,
+):
+    """
+    Ewald summation of q_i * sum_j' q_j/r_ij for a 3D periodic crystal.
+    This is the same quantity as the brute-force sums in
+    tutorial/calc_limit.py, i.e. the Madelung constant referred to the
+    length unit of the lattice vectors.
+
+    :param lattice: (3, 3) array, lattice vectors as rows
+    :param basis: (n_sites, 3) fractional coordinates
+    :param charges: (n_sites, ) charges, must sum to zero
+    :param site_index: index of the reference site i
+    :param accuracy: relative size of the neglected real and
+        reciprocal space terms
+    :return:
+    """
+    lattice, basis, charges = _check_ewald_input(lattice, basis, charges)
+    volume = abs(np.linalg.det(lattice))
+    positions = basis@lattice
+    r_ij = positions - positions[site_index]
+
+    # balance real and reciprocal space work
+    alpha = np.sqrt(np.pi)*(len(charges)/volume**2)**(1/6)
+    p = np.sqrt(-np.log(accuracy))
+    r_cut = p/alpha + np.max(np.linalg.norm(r_ij, axis=1))
+    g_cut = 2*alpha*p
+
+    # real space
+    vectors = get_lattice_vectors_in_sphere(lattice, r_cut)
+    dist = np.linalg.norm(
+        r_ij[:, np.newaxis, :] + vectors[np.newaxis, :, :],
+        axis=-1,
+    )
+    dist[dist == 0.0] = np.inf
+    real_part = np.sum(
+        charges[:, np.newaxis]*erfc(alpha*dist)/dist
+    )
+
+    # reciprocal space
+    reciprocal = 2*np.pi*np.linalg.inv(lattice).T
+    g_vectors = get_lattice_vectors_in_sphere(reciprocal, g_cut)
+    g_sq = np.sum(g_vectors**2, axis=1)
+    g_vectors = g_vectors[g_sq > 0.0]
+    g_sq = g_sq[g_sq > 0.0]
+    structure_factor = np.cos(g_vectors@r_ij.T)@charges
+    reciprocal_part = 4*np.pi/volume*np.sum(
+        np.exp(-g_sq/4/alpha**2)/g_sq*structure_factor
+    )
+
+    self_part = -2*alpha/np.sqrt(np.pi)*charges[site_index]
+
+    result = charges[site_index]*(real_part + reciprocal_part + self_part)
+
+    return result
+
+
+def calc_Madelung_ewald_2D(
+    lattice: np.ndarray,
+    basis: np.ndarray,
+    charges: np.ndarray,
+    site_index=0,
+    accuracy=1e-16,
+):
+    """
+    2D Ewald (Parry) summation of q_i * sum_j' q_j/r_ij for a single
+    layer of point charges with 1/r interaction.
+
+    :param lattice: (2, 2) array, lattice vectors as rows
+    :param basis: (n_sites, 2) fractional coordinates
+    :param charges: (n_sites, ) charges, must sum to zero
+    :param site_index: index of the reference site i
+    :param accuracy: relative size of the neglected real and
+        reciprocal space terms
+    :return:
+    """
+    lattice, basis, charges = _check_ewald_input(lattice, basis, charges)
+    area = abs(np.linalg.det(lattice))
+    positions = basis@lattice
+    r_ij = positions - positions[site_index]
+
+    alpha = np.sqrt(np.pi/area)
+    p = np.sqrt(-np.log(accuracy))
+    r_cut = p/alpha + np.max(np.linalg.norm(r_ij, axis=1))
+    g_cut = 2*alpha*p
+
+    # real space
+    vectors = get_lattice_vectors_in_sphere(lattice, r_cut)
+    dist = np.linalg.norm(
+        r_ij[:, np.newaxis, :] + vectors[np.newaxis, :, :],
+        axis=-1,
+    )
+    dist[dist == 0.0] = np.inf
+    real_part = np.sum(
+        charges[:, np.newaxis]*erfc(alpha*dist)/dist
+    )
+
+    # reciprocal space, the G=0 term vanishes for a neutral cell
+    reciprocal = 2*np.pi*np.linalg.inv(lattice).T
+    g_vectors = get_lattice_vectors_in_sphere(reciprocal, g_cut)
+    g_norm = np.linalg.norm(g_vectors, axis=1)
+    g_vectors = g_vectors[g_norm > 0.0]
+    g_norm = g_norm[g_norm > 0.0]
+    structure_factor = np.cos(g_vectors@r_ij.T)@charges
+    reciprocal_part = 2*np.pi/area*np.sum(
+        erfc(g_norm/2/alpha)/g_norm*structure_factor
+    )
+
+    self_part = -2*alpha/np.sqrt(np.pi)*charges[site_index]
+
+    result = charges[site_index]*(real_part + reciprocal_part + self_part)
+
+    return result
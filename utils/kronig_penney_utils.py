@@ -0,0 +1,407 @@
+import numpy as np
+from scipy.optimize import brentq, minimize_scalar
+
+from utils.constants import eV_to_J, hbar, m_e
+from utils.math_utils import bisect_elementwise, find_roots_bracketed
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# energies per chunk of the streaming evaluation, a few MB of temporaries
+DEFAULT_CHUNK_SIZE = 2**16
+
+
+def calc_f_KP(
+    E,
+    a,
+    b,
+    V_0,
+):
+    """
+    right hand side of the Kronig-Penney condition cos(k*(a+b)) = f(E),
+
+    f = cos(alpha*a)*cosh(beta*b)
+        + (beta^2 - alpha^2)/2*sin(alpha*a)/alpha*sinh(beta*b)/beta
+
+    with alpha^2 = 2*m_e*E/hbar^2 and beta^2 = 2*m_e*(V_0 - E)/hbar^2.
+    alpha and beta are taken as complex square roots, i.e. imaginary
+    where E < 0 or E > V_0, which turns cos into cosh and sin/x into
+    sinh/x and keeps f real and continuous, also at E = 0 and E = V_0.
+    There are no masks, so E may have any shape and order, and
+    E, a, b and V_0 are broadcast against each other, e.g.
+    E[:, np.newaxis] with arrays of V_0 for a sweep of depths.
+
+    :param E: unit J, float or array
+    :param a: width of the well, unit m, float or array
+    :param b: width of the barrier, unit m, float or array
+    :param V_0: height of the barrier, unit J, float or array
+    :return: array of the broadcast shape
+    """
+    alpha_sq = 2*m_e*np.asarray(E, dtype=float)/hbar**2
+    beta_sq = 2*m_e*np.asarray(V_0, dtype=float)/hbar**2 - alpha_sq
+    alpha = np.sqrt(alpha_sq + 0j)
+    beta = np.sqrt(beta_sq + 0j)
+    # sin(x*L)/x = L*sinc(x*L/pi) and sinh(x*L)/x = L*sinc(1j*x*L/pi),
+    # both L at x = 0
+    y = np.cos(alpha*a)*np.cosh(beta*b)
+    y += (beta_sq - alpha_sq)/2 \
+        * a*np.sinc(alpha*a/np.pi) \
+        * b*np.sinc(1j*beta*b/np.pi)
+    return y.real
+
+
+def get_KP_scan_grid(
+    a,
+    b,
+    E_max,
+    E_min=0.0,
+    points_per_period=32,
+):
+    """
+    energies uniform in alpha = sqrt(2*m_e*E)/hbar, with
+    points_per_period points per change of pi in alpha*(a+b), the phase
+    that bounds how fast f_KP oscillates
+
+    :param a: unit m
+    :param b: unit m
+    :param E_max: unit J
+    :param E_min: unit J, not negative
+    :param points_per_period:
+    :return: sorted array of E, unit J
+    """
+    alpha_min, alpha_max = np.sqrt(2*m_e*np.array([E_min, E_max]))/hbar
+    num_points = int(np.ceil(
+        (alpha_max - alpha_min)*(a + b)/np.pi*points_per_period
+    )) + 1
+    alpha = np.linspace(alpha_min, alpha_max, max(num_points, 2))
+    return (hbar*alpha)**2/2/m_e
+
+
+def find_band_edges(
+    a,
+    b,
+    V_0,
+    E_max,
+    E_min=0.0,
+    points_per_period=32,
+    xtol=1e-12*eV_to_J,
+    return_bands=False,
+):
+    """
+    all energies in [E_min, E_max] with |f_KP(E)| = 1, i.e. the edges of
+    the allowed bands. f - 1 and f + 1 are scanned on get_KP_scan_grid
+    and every sign change of either is refined with Brent's method,
+    so a band narrower than the grid, where f jumps from above 1 to
+    below -1 between two points, is found as well. A gap narrower than
+    the grid shows up as a local maximum of |f| below 1 on the grid,
+    then the maximum is located and both edges are bracketed against
+    it.
+
+    :param a: unit m
+    :param b: unit m
+    :param V_0: unit J
+    :param E_max: unit J
+    :param E_min: unit J, not negative
+    :param points_per_period: of the scan, see get_KP_scan_grid
+    :param xtol: absolute tolerance of the edges, unit J. Edges where
+        f is flat are only determined to about eps/|df/dE|
+    :param return_bands: also return the allowed bands
+    :return: sorted edges[, (n_bands, 2) array of (E_min, E_max) of each
+        band]. The bands are cut at E_min and E_max
+    """
+    def func(E):
+        return np.abs(calc_f_KP(E, a, b, V_0)) - 1.0
+
+    E_grid = get_KP_scan_grid(a, b, E_max, E_min, points_per_period)
+    f_grid = calc_f_KP(E_grid, a, b, V_0)
+    edges = []
+    for sign in (1.0, -1.0):
+        # roots of f = sign, sign*f - 1 is positive in the gaps of
+        # that sign
+        def func_sign(E):
+            return sign*calc_f_KP(E, a, b, V_0) - 1.0
+
+        edges.extend(find_roots_bracketed(func_sign, E_grid, xtol=xtol))
+
+        y_grid = sign*f_grid - 1.0
+        peaks = np.nonzero(
+            (y_grid[1:-1] < 0.0)
+            & (y_grid[1:-1] >= y_grid[:-2])
+            & (y_grid[1:-1] >= y_grid[2:])
+        )[0] + 1
+        for i in peaks:
+            peak = minimize_scalar(
+                lambda E: -func_sign(E),
+                bounds=(E_grid[i-1], E_grid[i+1]),
+                method='bounded',
+                options=dict(xatol=xtol),
+            )
+            if -peak.fun <= 0.0:
+                continue
+            edges.append(brentq(func_sign, E_grid[i-1], peak.x, xtol=xtol))
+            edges.append(brentq(func_sign, peak.x, E_grid[i+1], xtol=xtol))
+    edges = np.sort(np.array(edges))
+    if not return_bands:
+        return edges
+
+    # every edge is a crossing, so bands and gaps alternate. Only the
+    # first interval of nonzero width is tested, the bands of a deep
+    # well can be too narrow to hold a float between their edges
+    bounds = np.concatenate([[E_min], edges, [E_max]])
+    widths = np.diff(bounds)
+    first = np.argmax(widths > 0.0)
+    middle = (bounds[first] + bounds[first+1])/2
+    parity = (np.arange(len(widths)) - first) % 2 == 1
+    allowed = parity != (func(middle) <= 0.0)
+    # drop empty intervals at the ends of the range
+    allowed[[0, -1]] &= widths[[0, -1]] > 0.0
+    bands = np.stack([bounds[:-1][allowed], bounds[1:][allowed]], axis=-1)
+    return edges, bands
+
+
+def _expand(values, num_axes):
+    return np.reshape(values, np.shape(values) + (1, )*num_axes)
+
+
+def _maximize_golden(func, low, high, xtol):
+    """
+    elementwise golden section search of the maximum of a unimodal
+    func on [low, high]
+
+    :param func: vectorized
+    :param low: array
+    :param high: array of the same shape
+    :param xtol: absolute tolerance
+    :return: array of arguments of the maxima
+    """
+    ratio = (np.sqrt(5.0) - 1.0)/2
+    width = np.nanmax(high - low, initial=0.0)
+    num_iterations = int(np.ceil(
+        np.log(max(width/xtol, 1.0))/np.log(1.0/ratio)
+    ))
+    x_1 = high - ratio*(high - low)
+    x_2 = low + ratio*(high - low)
+    y_1 = func(x_1)
+    y_2 = func(x_2)
+    for _ in range(min(num_iterations, 1500)):
+        left = y_1 >= y_2
+        # keep [low, x_2] where the left point is higher, else [x_1, high]
+        high = np.where(left, x_2, high)
+        low = np.where(left, low, x_1)
+        x_new = np.where(
+            left,
+            high - ratio*(high - low),
+            low + ratio*(high - low),
+        )
+        y_new = func(x_new)
+        x_1, x_2 = np.where(left, x_new, x_2), np.where(left, x_1, x_new)
+        y_1, y_2 = np.where(left, y_new, y_2), np.where(left, y_1, y_new)
+    return (low + high)/2
+
+
+def find_band_edges_batch(
+    a,
+    b,
+    V_0,
+    num_bands,
+    points_per_period=16,
+    xtol=1e-12*eV_to_J,
+):
+    """
+    the first num_bands allowed bands of many Kronig-Penney potentials
+    at once, all as array operations over the parameters.
+    f_KP has exactly one extremum in every gap, closed or not, and is
+    monotonic in the bands in between. The extrema are located on a
+    grid uniform in alpha (see get_KP_scan_grid), which only has to
+    resolve the bands and not the gaps, and refined by golden section
+    search. Then the edges of band n are the roots of f = +-1 between
+    extremum n-1 (E = 0 for n = 1) and extremum n, found by bisection.
+
+    :param a: unit m, float or array
+    :param b: unit m, float or array
+    :param V_0: unit J, positive, float or array
+    :param num_bands:
+    :param points_per_period: of the scan for the extrema
+    :param xtol: absolute tolerance of the edges, unit J
+    :return: array of shape (broadcast shape of a, b, V_0) + (num_bands, 2)
+        of (E_min, E_max)
+    """
+    a, b, V_0 = np.broadcast_arrays(
+        np.asarray(a, dtype=float),
+        np.asarray(b, dtype=float),
+        np.asarray(V_0, dtype=float),
+    )
+    # the scan passes extremum num_bands both for free-electron like
+    # bands, alpha*a + beta*b > (num_bands+1)*pi, and for tight-binding
+    # like bands near the levels of the well, alpha*a = n*pi
+    alpha_barrier = np.sqrt(2*m_e*np.maximum(V_0, 0.0))/hbar
+    alpha_max = np.maximum(
+        ((num_bands + 1)*np.pi + alpha_barrier*b)/(a + b),
+        (num_bands + 1)*np.pi/a,
+    )
+    num_points = int(np.ceil(
+        np.max(alpha_max*(a + b))/np.pi*points_per_period
+    )) + 1
+    alpha = _expand(alpha_max, 1)*np.linspace(0.0, 1.0, num_points)
+    E_grid = (hbar*alpha)**2/2/m_e
+    f_grid = calc_f_KP(
+        E_grid, _expand(a, 1), _expand(b, 1), _expand(V_0, 1),
+    )
+    slope = np.diff(f_grid, axis=-1)
+    is_extremum = slope[..., :-1]*slope[..., 1:] <= 0.0
+    # the n-th extremum (1-based) sits at grid point argmax(count == n) + 1
+    count = np.cumsum(is_extremum, axis=-1)
+    index = np.stack([
+        np.argmax(count == n + 1, axis=-1) + 1 for n in range(num_bands)
+    ], axis=-1)
+
+    def get_f(E):
+        return calc_f_KP(
+            E, _expand(a, 1), _expand(b, 1), _expand(V_0, 1),
+        )
+
+    sign = np.sign(np.take_along_axis(f_grid, index, axis=-1))
+    extrema = _maximize_golden(
+        lambda E: sign*get_f(E),
+        np.take_along_axis(E_grid, index - 1, axis=-1),
+        np.take_along_axis(E_grid, index + 1, axis=-1),
+        xtol,
+    )
+    low = np.concatenate([np.zeros(a.shape + (1, )), extrema[..., :-1]], -1)
+    # f at the lower end of band n is -sign of extremum n
+    bands = np.stack([
+        bisect_elementwise(
+            lambda E: get_f(E) + sign, low, extrema, xtol, -sign,
+        ),
+        bisect_elementwise(
+            lambda E: get_f(E) - sign, low, extrema, xtol, -sign,
+        ),
+    ], axis=-1)
+    return bands
+
+
+def calc_band_structure(
+    k,
+    a,
+    b,
+    V_0,
+    num_bands,
+    points_per_period=64,
+    xtol=1e-12*eV_to_J,
+):
+    """
+    E_n(k) of the first num_bands Kronig-Penney bands, solving
+    cos(k*(a+b)) = f_KP(E) inside every band of find_band_edges_batch,
+    where f_KP is monotonic, by bisection over all k, bands and
+    parameter sets at once
+
+    :param k: (n_k, ) wave vectors, unit 1/m, e.g. in [0, pi/(a+b)]
+    :param a: unit m, float or array
+    :param b: unit m, float or array
+    :param V_0: unit J, float or array
+    :param num_bands:
+    :param points_per_period: of the band edge scan
+    :param xtol: absolute tolerance of E, unit J
+    :return: array of shape (broadcast shape of a, b, V_0)
+        + (num_bands, n_k), unit J
+    """
+    bands = find_band_edges_batch(
+        a, b, V_0, num_bands,
+        points_per_period=points_per_period,
+        xtol=xtol,
+    )
+    a, b, V_0 = (_expand(np.asarray(x, dtype=float), 2) for x in (a, b, V_0))
+    cos_k = np.cos(np.asarray(k, dtype=float)*(a + b))
+
+    def func(E):
+        return calc_f_KP(E, a, b, V_0) - cos_k
+
+    low, high, _ = np.broadcast_arrays(
+        bands[..., 0:1], bands[..., 1:2], cos_k,
+    )
+    # f is +-1 at the lower edge of a band
+    sign_low = np.sign(calc_f_KP(low, a, b, V_0))
+    return bisect_elementwise(func, low, high, xtol, sign_low)
+
+
+def iter_f_KP_chunks(
+    a,
+    b,
+    V_0,
+    E_start,
+    E_stop,
+    step,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """
+    f_KP on the grid np.arange(E_start, E_stop, step), one chunk at a
+    time, so memory does not depend on how fine the grid is.
+    The grid points are E_start + i*step as in np.arange.
+
+    :param a: unit m
+    :param b: unit m
+    :param V_0: unit J
+    :param E_start: unit J
+    :param E_stop: unit J, excluded
+    :param step: unit J
+    :param chunk_size: number of energies per chunk
+    :return: generator of (E, f) arrays of at most chunk_size
+    """
+    num_points = max(int(np.ceil((E_stop - E_start)/step)), 0)
+    for start in range(0, num_points, chunk_size):
+        E = E_start + np.arange(
+            start, min(start+chunk_size, num_points), dtype=float,
+        )*step
+        yield E, calc_f_KP(E, a, b, V_0)
+
+
+def iter_crossings(
+    a,
+    b,
+    V_0,
+    E_start,
+    E_stop,
+    step,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    xtol=None,
+):
+    """
+    crossings of |f_KP| = 1 on the grid np.arange(E_start, E_stop, step)
+    as they are found, chunk by chunk. The last sample of each chunk is
+    carried over, so crossings between chunks are not missed, and the
+    result is the same as find_intersection in hw08 on the whole grid.
+
+    :param a: unit m
+    :param b: unit m
+    :param V_0: unit J
+    :param E_start: unit J
+    :param E_stop: unit J, excluded
+    :param step: unit J
+    :param chunk_size: number of energies per chunk
+    :param xtol: if given, refine every crossing with Brent's method to
+        this absolute tolerance instead of yielding the grid point
+        before it
+    :return: generator of floats, unit J, increasing
+    """
+    def func(E):
+        return np.abs(calc_f_KP(E, a, b, V_0)) - 1.0
+
+    E_last = None
+    y_last = None
+    for E, f in iter_f_KP_chunks(
+        a, b, V_0, E_start, E_stop, step, chunk_size,
+    ):
+        y = np.abs(f) - 1.0
+        if E_last is not None:
+            E = np.concatenate([[E_last], E])
+            y = np.concatenate([[y_last], y])
+        for i in np.nonzero(y[:-1]*y[1:] < 0.0)[0]:
+            if xtol is None:
+                yield float(E[i])
+            else:
+                yield brentq(func, E[i], E[i+1], xtol=xtol)
+        E_last = E[-1]
+        y_last = y[-1]
@@ -0,0 +1,222 @@
+from functools import partial
+
+import numpy as np
+from scipy.optimize import minimize
+
+from utils.lattice_sum_utils import DEFAULT_BLOCK_SIZE, sum_lattice
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# (i, j) of the independent metric tensor components,
+# in the order of the lattice parameters (a, b[, c]) then the angles
+METRIC_COMPONENTS = {
+    2: ((0, 0), (1, 1), (0, 1)),
+    3: ((0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)),
+}
+
+
+def _lennard_jones_r_sq(
+    r_sq: np.ndarray,
+    sigma: float,
+    epsilon: float,
+):
+    s_6 = (sigma**2/r_sq)**3
+    s_12 = s_6**2
+    value = 4*epsilon*(s_12 - s_6)
+    d_1 = 4*epsilon*(-6*s_12 + 3*s_6)/r_sq
+    d_2 = 4*epsilon*(42*s_12 - 12*s_6)/r_sq**2
+    return value, d_1, d_2
+
+
+def lennard_jones(sigma: float, epsilon: float):
+    """
+    Lennard-Jones pair potential as a function of r^2
+
+    :param sigma:
+    :param epsilon:
+    :return: potential(r_sq) -> (value, d/d(r^2), d^2/d(r^2)^2)
+    """
+    return partial(_lennard_jones_r_sq, sigma=sigma, epsilon=epsilon)
+
+
+def get_metric_tensor(params):
+    """
+    metric components g = (G_11, G_22[, G_33], G_23, G_13, G_12) and their
+    first and second derivatives w.r.t. the lattice parameters
+
+    :param params: (a, b, gamma) in 2D or (a, b, c, alpha, beta, gamma)
+        in 3D. Angles in Radian
+    :return: g (k, ), dg/dp (k, k), d2g/dp2 (k, k, k)
+    """
+    params = np.asarray(params, dtype=float)
+    if len(params) == 3:
+        dim = 2
+        lengths = params[:2]
+        # the angle between a and b
+        pairs = ((0, 1, 2), )
+    elif len(params) == 6:
+        dim = 3
+        lengths = params[:3]
+        # (length i, length j, angle index) for alpha, beta, gamma
+        pairs = ((1, 2, 3), (0, 2, 4), (0, 1, 5))
+    else:
+        raise NotImplementedError
+    k = len(params)
+
+    g = np.zeros(k)
+    d_1 = np.zeros((k, k))
+    d_2 = np.zeros((k, k, k))
+    for i in range(dim):
+        g[i] = lengths[i]**2
+        d_1[i, i] = 2*lengths[i]
+        d_2[i, i, i] = 2.0
+    for i, j, m in pairs:
+        cos_m = np.cos(params[m])
+        sin_m = np.sin(params[m])
+        g[m] = lengths[i]*lengths[j]*cos_m
+        d_1[m, i] = lengths[j]*cos_m
+        d_1[m, j] = lengths[i]*cos_m
+        d_1[m, m] = -lengths[i]*lengths[j]*sin_m
+        d_2[m, i, j] = d_2[m, j, i] = cos_m
+        d_2[m, i, m] = d_2[m, m, i] = -lengths[j]*sin_m
+        d_2[m, j, m] = d_2[m, m, j] = -lengths[i]*sin_m
+        d_2[m, m, m] = -lengths[i]*lengths[j]*cos_m
+    return g, d_1, d_2
+
+
+def term_lattice_energy(
+    indices: np.ndarray,
+    metric: np.ndarray,
+    potential,
+    order=2,
+):
+    """
+    rows [psi, psi'*c_k, psi''*c_k*c_l] with r^2 = sum_k g_k*c_k(n),
+    i.e. everything needed for the energy, gradient and Hessian
+    w.r.t. the metric components g. The origin is left out.
+
+    :param indices: (n_points, dim) integer array
+    :param metric: (k, ) metric components g
+    :param potential: potential(r_sq) -> (value, d1, d2)
+    :param order: 0 for the energy only, 1 adds the gradient,
+        2 adds the Hessian
+    :return: (1 [+ k [+ k*k]], n_points) array
+    """
+    dim = indices.shape[-1]
+    indices = indices[np.any(indices != 0, axis=-1)].astype(float)
+    coeffs = np.stack([
+        indices[:, i]*indices[:, j]*(1.0 if i == j else 2.0)
+        for i, j in METRIC_COMPONENTS[dim]
+    ])
+    r_sq = metric@coeffs
+    value, d_1, d_2 = potential(r_sq)
+
+    rows = [value[np.newaxis, :]]
+    if order >= 1:
+        rows.append(d_1*coeffs)
+    if order >= 2:
+        rows.append(
+            (d_2*coeffs[:, np.newaxis, :]*coeffs[np.newaxis, :, :])
+            .reshape(-1, len(r_sq))
+        )
+    return np.concatenate(rows, axis=0)
+
+
+def calc_lattice_energy(
+    params,
+    potential,
+    value_range=30,
+    order=2,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    energy per atom of a Bravais lattice, 1/2*sum_n' phi(|n|), with its
+    analytic gradient and Hessian w.r.t. the lattice parameters,
+    all from one pass over the lattice
+
+    :param params: (a, b, gamma) in 2D or (a, b, c, alpha, beta, gamma)
+        in 3D. Angles in Radian
+    :param potential: potential(r_sq) -> (value, d1, d2), e.g.
+        lennard_jones(sigma, epsilon)
+    :param value_range: half width of the summed cube of indices
+    :param order: 0 for the energy only, 1 adds the gradient,
+        2 adds the Hessian
+    :param block_size: number of terms evaluated at once
+    :return: energy[, gradient (k, )[, Hessian (k, k)]]
+    """
+    g, d_g, d2_g = get_metric_tensor(params)
+    k = len(g)
+    dim = 2 if k == 3 else 3
+    num_rows = 1 + (k if order >= 1 else 0) + (k*k if order >= 2 else 0)
+    sums = sum_lattice(
+        term_func=partial(
+            term_lattice_energy,
+            metric=g,
+            potential=potential,
+            order=order,
+        ),
+        value_range=value_range,
+        dim=dim,
+        block_size=max(block_size//num_rows, 1),
+    )/2.0
+
+    energy = sums[0]
+    if order == 0:
+        return energy
+    grad_g = sums[1:1+k]
+    gradient = d_g.T@grad_g
+    if order == 1:
+        return energy, gradient
+    hess_g = sums[1+k:].reshape(k, k)
+    hessian = d_g.T@hess_g@d_g + np.einsum('k,kmn->mn', grad_g, d2_g)
+    return energy, gradient, hessian
+
+
+def relax_lattice(
+    params,
+    potential,
+    value_range=30,
+    method='L-BFGS-B',
+    tol=1e-14,
+):
+    """
+    minimize the energy per atom w.r.t. all the lattice parameters
+    with a quasi-Newton method and the analytic gradient. Methods that
+    use a Hessian (e.g. 'trust-exact') get the analytic one.
+
+    :param params: initial (a, b, gamma) or (a, b, c, alpha, beta, gamma)
+    :param potential: potential(r_sq) -> (value, d1, d2)
+    :param value_range: half width of the summed cube of indices
+    :param method: passed to scipy.optimize.minimize
+    :param tol: passed to scipy.optimize.minimize
+    :return: relaxed params, energy per atom
+    """
+    params = np.asarray(params, dtype=float)
+    dim = 2 if len(params) == 3 else 3
+    bounds = (
+        [(1e-3*np.max(params[:dim]), None)]*dim
+        + [(1e-3, np.pi-1e-3)]*(len(params)-dim)
+    )
+    use_hessian = method in (
+        'Newton-CG', 'dogleg', 'trust-ncg', 'trust-krylov', 'trust-exact',
+    )
+    result = minimize(
+        fun=calc_lattice_energy,
+        x0=params,
+        args=(potential, value_range, 1),
+        jac=True,
+        hess=(
+            (lambda x, *args: calc_lattice_energy(
+                x, potential, value_range, order=2,
+            )[2])
+            if use_hessian else None
+        ),
+        method=method,
+        bounds=bounds if method in ('L-BFGS-B', 'TNC', 'SLSQP') else None,
+        tol=tol,
+    )
+    return result.x, result.fun
@@ -0,0 +1,186 @@
+import warnings
+from functools import partial
+
+import numpy as np
+
+from utils.lattice_sum_utils import (
+    DEFAULT_BLOCK_SIZE,
+    map_blocks,
+    merge_partial_sums,
+)
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+HAS_NUMBA = numba is not None
+BACKENDS = ('numpy', 'numba')
+
+
+def use_numba(backend: str, plain=True):
+    """
+    whether a lattice sum should run the compiled loop of sum_lattice_loop.
+    Falls back to NumPy with a warning if numba is not installed
+
+    :param backend: 'numpy' or 'numba'
+    :param plain: whether the requested sum is a plain sum over the cube
+        of indices, the only one the loop covers
+    :return: bool
+    """
+    if backend not in BACKENDS:
+        raise ValueError('unknown backend {}'.format(backend))
+    if backend == 'numpy':
+        return False
+    if not plain:
+        raise ValueError(
+            "backend='numba' needs a plain sum: no tol, symmetry, "
+            "extrapolation, reduction or return_error"
+        )
+    if not HAS_NUMBA:
+        warnings.warn('numba is not installed, using the NumPy backend')
+    return HAS_NUMBA
+
+
+def _sum_range_loop(
+    start,
+    stop,
+    value_range,
+    lattices,
+    shifts,
+    weights,
+    powers,
+    with_uv,
+    alternating,
+):
+    """
+    points start..stop-1 of the cube of indices in C order (the order of
+    get_index_block), one pass with no temporary arrays.
+    Compiled by numba, also runs as plain Python.
+
+    :return: high, low of shape (n_powers, n_lattices), the Neumaier sum
+    """
+    n_lattices = lattices.shape[0]
+    dim = lattices.shape[1]
+    n_powers = powers.shape[0]
+    high = np.zeros((n_powers, n_lattices))
+    low = np.zeros((n_powers, n_lattices))
+    width = 2*value_range + 1
+    index = np.zeros(dim)
+    for flat in range(start, stop):
+        rest = flat
+        parity = 0
+        for k in range(dim-1, -1, -1):
+            n_k = rest % width - value_range
+            rest //= width
+            parity ^= n_k & 1
+            index[k] = n_k
+        sign = 1.0 - 2.0*parity if alternating else 1.0
+        uv = index[0]*index[1] if dim > 1 else 0.0
+        for m in range(n_lattices):
+            for s in range(shifts.shape[0]):
+                r_sq = 0.0
+                for j in range(dim):
+                    r_j = shifts[s, j]
+                    for k in range(dim):
+                        r_j += index[k]*lattices[m, k, j]
+                    r_sq += r_j*r_j
+                if r_sq == 0.0:
+                    continue
+                for p in range(n_powers):
+                    term = sign*weights[s]/r_sq**powers[p]
+                    if with_uv[p]:
+                        term *= uv
+                    total = high[p, m] + term
+                    if abs(high[p, m]) >= abs(term):
+                        low[p, m] += (high[p, m] - total) + term
+                    else:
+                        low[p, m] += (term - total) + high[p, m]
+                    high[p, m] = total
+    return high, low
+
+
+if HAS_NUMBA:
+    _sum_range_compiled = numba.njit(cache=True, nogil=True)(_sum_range_loop)
+else:
+    _sum_range_compiled = _sum_range_loop
+
+
+def _sum_loop_range(start, block_size, num_points, **kwargs):
+    high, low = _sum_range_compiled(
+        start,
+        min(start+block_size, num_points),
+        **kwargs,
+    )
+    return high, low, 0.0
+
+
+def sum_lattice_loop(
+    lattice: np.ndarray,
+    power,
+    value_range: int,
+    shifts=None,
+    weights=None,
+    with_uv=False,
+    alternating=False,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+):
+    """
+    sum over [-value_range, value_range]^dim of
+    sum_s sign*weights_s*[u*v]/|n @ lattice + shifts_s|^(2*power),
+    the terms with r = 0 are left out. The index loop, r^2, the power and
+    the accumulation are fused into one compiled pass without the
+    temporary arrays of the NumPy term functions. Every term is added
+    with Neumaier compensation, in double precision.
+
+    :param lattice: (dim, dim) array, or ([n_lattices, ]dim, dim) to sum
+        e.g. many angles of a rhombus in one pass
+    :param power: float or (n_powers, ) array
+    :param value_range:
+    :param shifts: (n_sites, dim) Cartesian shifts, the origin if None
+    :param weights: (n_sites, ) weights, all ones if None
+    :param with_uv: bool or (n_powers, ) array, multiply the terms by the
+        product of the first two indices
+    :param alternating: multiply the terms by (-1)^(n_1+...+n_dim)
+    :param block_size: number of lattice points per task
+    :param workers: number of processes, None for all cores
+    :return: float or array of shape ([n_powers, ][n_lattices])
+    """
+    lattice = np.asarray(lattice, dtype=float)
+    dim = lattice.shape[-1]
+    if shifts is None:
+        shifts = np.zeros((1, dim))
+    if weights is None:
+        weights = np.ones(len(shifts))
+    powers = np.ravel(np.asarray(power, dtype=float))
+    num_points = (2*value_range + 1)**dim
+    result = merge_partial_sums(
+        map_blocks(
+            func=partial(
+                _sum_loop_range,
+                block_size=block_size,
+                num_points=num_points,
+                value_range=value_range,
+                lattices=np.reshape(lattice, (-1, dim, dim)),
+                shifts=np.asarray(shifts, dtype=float),
+                weights=np.asarray(weights, dtype=float),
+                powers=powers,
+                with_uv=np.broadcast_to(with_uv, powers.shape).astype(bool),
+                alternating=alternating,
+            ),
+            items=range(0, num_points, block_size),
+            workers=workers,
+        ),
+        reduction='compensated',
+    )
+    result = np.reshape(result, np.shape(power)+lattice.shape[:-2])
+    if np.ndim(result) == 0:
+        return float(result)
+    return result
@@ -0,0 +1,1312 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import numpy as np
+from scipy.special import gamma as gamma_function
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# number of lattice points evaluated at once, i.e. a few MB per temporary
+DEFAULT_BLOCK_SIZE = 2**18
+# largest index range the shell-ordered sums may reach before giving up
+DEFAULT_MAX_RANGE = 2000
+# unit roundoff of float64
+EPS = np.finfo(float).eps/2
+
+
+def get_index_block(
+    start: int,
+    stop: int,
+    value_range: int,
+    dim: int,
+):
+    """
+    points start..stop-1 of the integer cube [-value_range, value_range]^dim
+    in C order
+
+    :param start:
+    :param stop:
+    :param value_range:
+    :param dim:
+    :return: (stop-start, dim) int64 array
+    """
+    width = 2*value_range + 1
+    flat_indices = np.arange(start, stop, dtype=np.int64)
+    # column-major storage, the term functions read one column at a time
+    indices = np.empty((stop-start, dim), dtype=np.int64, order='F')
+    for k, column in enumerate(np.unravel_index(flat_indices, (width, )*dim)):
+        np.subtract(column, value_range, out=indices[:, k])
+    return indices
+
+
+def add_compensated(total, compensation, value):
+    """
+    Neumaier summation step, works elementwise on arrays
+
+    :param total: running sum
+    :param compensation: running low-order correction
+    :param value: value to add
+    :return: (total, compensation)
+    """
+    new_total = total + value
+    compensation = compensation + np.where(
+        np.abs(total) >= np.abs(value),
+        (total - new_total) + value,
+        (value - new_total) + total,
+    )
+    return new_total, compensation
+
+
+def _two_sum(a, b):
+    # error-free transformation a + b = s + e
+    s = a + b
+    b_virtual = s - a
+    e = (a - (s - b_virtual)) + (b - b_virtual)
+    return s, e
+
+
+def _sum_cascade(terms):
+    """
+    pairwise summation of the last axis with the rounding error of
+    every addition kept by _two_sum, vectorized level by level
+
+    :param terms: (..., n) array
+    :return: high, low with high + low the compensated sum
+    """
+    high = terms
+    low = np.zeros(terms.shape[:-1])
+    if high.shape[-1] == 0:
+        return low.copy(), low
+    while high.shape[-1] > 1:
+        if high.shape[-1] % 2 == 1:
+            high = np.concatenate(
+                [high, np.zeros(high.shape[:-1]+(1, ))],
+                axis=-1,
+            )
+        high, error = _two_sum(high[..., 0::2], high[..., 1::2])
+        low = low + np.sum(error, axis=-1)
+    return high[..., 0], low
+
+
+def _sum_exact(terms):
+    """
+    correctly rounded sum of the last axis (math.fsum) and the rounded
+    remainder, i.e. the exact sum up to about eps^2
+
+    :param terms: (..., n) array
+    :return: high, low
+    """
+    rows = np.reshape(
+        terms, (int(np.prod(terms.shape[:-1])), terms.shape[-1]),
+    )
+    high = np.array([math.fsum(row) for row in rows])
+    low = np.array([
+        math.fsum(np.append(row, -h)) for row, h in zip(rows, high)
+    ])
+    return (
+        np.reshape(high, terms.shape[:-1]),
+        np.reshape(low, terms.shape[:-1]),
+    )
+
+
+def _get_pairwise_roundings(n: int):
+    # numpy sums runs of 128 with 8 accumulators of 16 terms each and
+    # splits longer arrays in halves, which bounds the number of roundings
+    # any term goes through
+    return 19 + max(int(np.ceil(np.log2(max(n, 1)/128))), 0)
+
+
+def reduce_terms(terms, reduction='pairwise', with_error=False):
+    """
+    sum of the last axis of terms
+
+    'pairwise': np.sum, error up to (19 + log2(n/128))*eps*sum|t|
+    'compensated': cascaded pairwise sum keeping the rounding error of
+        every addition, error of order (eps*log2(n))^2*sum|t|
+    'exact': math.fsum, correctly rounded, slow
+
+    :param terms: (..., n) array
+    :param reduction: 'pairwise', 'compensated' or 'exact'
+    :param with_error: also bound the rounding error of the summation,
+        not of the terms themselves, see calc_inverse_power
+    :return: high, low, error. high + low is the sum, low is 0.0 for
+        'pairwise' and error is 0.0 if not with_error
+    """
+    n = terms.shape[-1]
+    if reduction == 'pairwise':
+        # single precision terms are accumulated in double precision
+        high = np.sum(terms, axis=-1, dtype=np.float64)
+        low = 0.0
+        order = _get_pairwise_roundings(n)*EPS
+    elif reduction == 'compensated':
+        high, low = _sum_cascade(terms.astype(np.float64, copy=False))
+        order = 2*(EPS*(np.log2(max(n, 1)) + 1))**2
+    elif reduction == 'exact':
+        high, low = _sum_exact(terms.astype(np.float64, copy=False))
+        order = EPS**2
+    else:
+        raise ValueError('unknown reduction {}'.format(reduction))
+    error = 0.0
+    if with_error:
+        error = order*np.sum(np.abs(terms), axis=-1, dtype=np.float64)
+    return high, low, error
+
+
+def sum_block(term_func, block, reduction='pairwise', with_error=False):
+    """
+    sum of the terms of one index block, see reduce_terms
+
+    :param term_func: maps an (n_points, dim) index array to terms
+        of shape (..., n_points)
+    :param block: index array, or (indices, weights) tuple in which case
+        every term is multiplied by its weight
+    :param reduction: 'pairwise', 'compensated' or 'exact'
+    :param with_error: also bound the rounding error
+    :return: high, low, error
+    """
+    if isinstance(block, tuple):
+        indices, weights = block
+        terms = term_func(indices)*weights
+    else:
+        terms = term_func(block)
+    return reduce_terms(terms, reduction=reduction, with_error=with_error)
+
+
+def merge_partial_sums(
+    partials,
+    reduction='pairwise',
+    return_error=False,
+):
+    """
+    sum of block partial sums in the given order, Neumaier compensated,
+    or with math.fsum for reduction='exact'
+
+    :param partials: iterable of (high, low, error) from sum_block,
+        floats or arrays of equal shape
+    :param reduction: 'pairwise', 'compensated' or 'exact'
+    :param return_error: also return the bound of the rounding error
+    :return: sum[, error]
+    """
+    total = 0.0
+    compensation = 0.0
+    error = 0.0
+    magnitude = 0.0
+    num_partials = 0
+    parts = []
+    for high, low, block_error in partials:
+        error = error + block_error
+        num_partials += 1
+        if reduction == 'exact':
+            parts.append(high)
+            parts.append(low)
+            continue
+        magnitude = magnitude + np.abs(high)
+        total, compensation = add_compensated(total, compensation, high)
+        if reduction == 'compensated':
+            total, compensation = add_compensated(total, compensation, low)
+
+    if reduction == 'exact':
+        if parts:
+            stacked = np.stack(np.broadcast_arrays(*parts), axis=-1)
+            result = _sum_exact(stacked)[0]
+        else:
+            result = np.float64(0.0)
+        error = error + EPS*np.abs(result)
+    else:
+        result = total + compensation
+        # Neumaier: 2*eps*|sum| + n*eps^2*sum|x|
+        error = error + 2*EPS*np.abs(result) \
+            + num_partials*EPS**2*magnitude
+    if np.ndim(result) == 0:
+        result = float(result)
+        error = float(error)
+    if return_error:
+        return result, error
+    return result
+
+
+# the process pool of map_blocks, kept between calls since starting the
+# processes costs far more than a small sum
+_POOL = None
+_POOL_WORKERS = None
+
+
+def _get_pool(workers):
+    global _POOL, _POOL_WORKERS
+    if _POOL is None or _POOL_WORKERS != workers:
+        if _POOL is not None:
+            _POOL.shutdown()
+        _POOL = ProcessPoolExecutor(max_workers=workers)
+        _POOL_WORKERS = workers
+    return _POOL
+
+
+def shutdown_pool():
+    """
+    stop the processes of map_blocks, they are started again when needed
+    """
+    global _POOL, _POOL_WORKERS
+    if _POOL is not None:
+        _POOL.shutdown()
+    _POOL = None
+    _POOL_WORKERS = None
+
+
+def map_blocks(func, items, workers=1, executor=None):
+    """
+    func over items, in order. With workers > 1 the items are spread
+    over a process pool, func and items must then be picklable, e.g.
+    functools.partial of module level functions. Only the results travel
+    back, and they are returned in the order of items whatever the
+    number of workers, so a following merge is bit-reproducible.
+    The pool is kept for later calls, see shutdown_pool. With fewer
+    items than workers the items are mapped in this process.
+
+    :param func:
+    :param items: sequence
+    :param workers: number of processes, None for all cores
+    :param executor: concurrent.futures executor to use instead of the
+        pool of this module
+    :return: iterable of func(item)
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if executor is None and (workers == 1 or len(items) < workers):
+        return map(func, items)
+    if executor is None:
+        executor = _get_pool(workers)
+    try:
+        return list(executor.map(
+            func,
+            items,
+            chunksize=max(len(items)//(4*workers), 1),
+        ))
+    except BrokenProcessPool:
+        # a worker died, start a fresh pool next time
+        if executor is _POOL:
+            shutdown_pool()
+        raise
+
+
+def _sum_index_range(
+    start: int,
+    term_func,
+    value_range: int,
+    dim: int,
+    block_size: int,
+    reduction='pairwise',
+    with_error=False,
+):
+    num_points = (2*value_range + 1)**dim
+    indices = get_index_block(
+        start=start,
+        stop=min(start+block_size, num_points),
+        value_range=value_range,
+        dim=dim,
+    )
+    return sum_block(term_func, indices, reduction, with_error)
+
+
+def sum_lattice(
+    term_func,
+    value_range: int,
+    dim: int,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    reduction='pairwise',
+    return_error=False,
+):
+    """
+    sum term_func over [-value_range, value_range]^dim with memory
+    O(block_size) independent of value_range.
+    The blocks do not depend on workers, so neither do the bits of
+    the result.
+
+    :param term_func: maps an (n_points, dim) index array to terms
+    :param value_range:
+    :param dim:
+    :param block_size:
+    :param workers: number of processes, None for all cores
+    :param reduction: 'pairwise', 'compensated' or 'exact',
+        see reduce_terms
+    :param return_error: also return the bound of the rounding error
+    :return: sum[, error]
+    """
+    num_points = (2*value_range + 1)**dim
+    return merge_partial_sums(
+        map_blocks(
+            func=partial(
+                _sum_index_range,
+                term_func=term_func,
+                value_range=value_range,
+                dim=dim,
+                block_size=block_size,
+                reduction=reduction,
+                with_error=return_error,
+            ),
+            items=range(0, num_points, block_size),
+            workers=workers,
+        ),
+        reduction=reduction,
+        return_error=return_error,
+    )
+
+
+def get_cube_shell_boxes(inner_range: int, value_range: int, dim: int):
+    """
+    the integer points with inner_range < max(|n_i|) <= value_range as
+    non-overlapping boxes, i.e. products of one index array per axis.
+    In box k, axis k is the first one with |n_k| > inner_range.
+
+    :param inner_range: -1 for the whole cube
+    :param value_range:
+    :param dim:
+    :return: list of boxes, each a list of dim int64 arrays
+    """
+    full = np.arange(-value_range, value_range+1, dtype=np.int64)
+    if inner_range < 0:
+        return [[full]*dim]
+    inner = np.arange(-inner_range, inner_range+1, dtype=np.int64)
+    outer = full[np.abs(full) > inner_range]
+    return [[inner]*k + [outer] + [full]*(dim-k-1) for k in range(dim)]
+
+
+def get_box_block(box, start: int, stop: int):
+    """
+    points start..stop-1 of a box of get_cube_shell_boxes in C order
+
+    :param box: list of dim int64 arrays
+    :param start:
+    :param stop:
+    :return: (stop-start, dim) int64 array
+    """
+    flat_indices = np.arange(start, stop, dtype=np.int64)
+    shape = tuple(len(axis) for axis in box)
+    indices = np.empty((stop-start, len(box)), dtype=np.int64, order='F')
+    for k, column in enumerate(np.unravel_index(flat_indices, shape)):
+        np.take(box[k], column, out=indices[:, k])
+    return indices
+
+
+def _sum_box_range(
+    item,
+    term_func,
+    block_size: int,
+    reduction='pairwise',
+    with_error=False,
+):
+    box, start = item
+    num_points = int(np.prod([len(axis) for axis in box]))
+    indices = get_box_block(box, start, min(start+block_size, num_points))
+    return sum_block(term_func, indices, reduction, with_error)
+
+
+def sum_cube_shell(
+    term_func,
+    inner_range: int,
+    value_range: int,
+    dim: int,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    reduction='pairwise',
+    return_error=False,
+):
+    """
+    sum term_func over the points with
+    inner_range < max(|n_i|) <= value_range, so that the sum over the
+    cube of value_range is the sum over the cube of inner_range plus
+    this one, at the cost of the new points only
+
+    :param term_func: maps an (n_points, dim) index array to terms
+    :param inner_range: -1 for the whole cube
+    :param value_range:
+    :param dim:
+    :param block_size:
+    :param workers: number of processes, None for all cores
+    :param reduction: 'pairwise', 'compensated' or 'exact',
+        see reduce_terms
+    :param return_error: also return the bound of the rounding error
+    :return: sum[, error]
+    """
+    items = []
+    for box in get_cube_shell_boxes(inner_range, value_range, dim):
+        num_points = int(np.prod([len(axis) for axis in box]))
+        items.extend(
+            (box, start) for start in range(0, num_points, block_size)
+        )
+    return merge_partial_sums(
+        map_blocks(
+            func=partial(
+                _sum_box_range,
+                term_func=term_func,
+                block_size=block_size,
+                reduction=reduction,
+                with_error=return_error,
+            ),
+            items=items,
+            workers=workers,
+        ),
+        reduction=reduction,
+        return_error=return_error,
+    )
+
+
+class LatticeSum:
+    """
+    sum of term_func over the cube [-value_range, value_range]^dim that
+    keeps its partial sum, so growing the cube with extend only
+    evaluates the new outer points, see sum_cube_shell
+    """
+    def __init__(
+        self,
+        term_func,
+        dim: int,
+        block_size=DEFAULT_BLOCK_SIZE,
+        workers=1,
+        reduction='pairwise',
+    ):
+        """
+
+        :param term_func: maps an (n_points, dim) index array to terms
+        :param dim:
+        :param block_size: number of lattice points evaluated at once
+        :param workers: number of processes, None for all cores
+        :param reduction: 'pairwise', 'compensated' or 'exact' summation
+            of the blocks, see reduce_terms. The shells are added with
+            Neumaier compensation, the bound of the rounding error of
+            both is the error property
+        """
+        self.term_func = term_func
+        self.dim = dim
+        self.block_size = block_size
+        self.workers = workers
+        self.reduction = reduction
+        # the empty cube
+        self.value_range = -1
+        self._total = 0.0
+        self._compensation = 0.0
+        self._error = 0.0
+        self._magnitude = 0.0
+        self._num_shells = 0
+
+    @property
+    def value(self):
+        """
+        the sum over the cube of the current value_range
+        """
+        result = self._total + self._compensation
+        if np.ndim(result) == 0:
+            return float(result)
+        return result
+
+    @property
+    def error(self):
+        """
+        the bound of the rounding error of value, see merge_partial_sums
+        """
+        result = self._error + 2*EPS*np.abs(self.value) \
+            + self._num_shells*EPS**2*self._magnitude
+        if np.ndim(result) == 0:
+            return float(result)
+        return result
+
+    @property
+    def num_points(self):
+        if self.value_range < 0:
+            return 0
+        return (2*self.value_range + 1)**self.dim
+
+    def extend(self, to: int, return_error=False):
+        """
+        grow the cube to value_range=to, evaluating only the points
+        outside the current one
+
+        :param to: new value_range, not smaller than the current one
+        :param return_error: also return the bound of the rounding error
+        :return: the sum over the new cube[, error]
+        """
+        if to < self.value_range:
+            raise ValueError(
+                'cannot shrink value_range from {} to {}'.format(
+                    self.value_range, to,
+                )
+            )
+        if to > self.value_range:
+            shell_sum, shell_error = sum_cube_shell(
+                term_func=self.term_func,
+                inner_range=self.value_range,
+                value_range=to,
+                dim=self.dim,
+                block_size=self.block_size,
+                workers=self.workers,
+                reduction=self.reduction,
+                return_error=True,
+            )
+            self._total, self._compensation = add_compensated(
+                self._total, self._compensation, shell_sum,
+            )
+            self._error = self._error + shell_error
+            self._magnitude = self._magnitude + np.abs(shell_sum)
+            self._num_shells += 1
+            self.value_range = to
+        if return_error:
+            return self.value, self.error
+        return self.value
+
+
+def _descending_tuples(low: int, high: int, dim: int):
+    """
+    all integer tuples high >= n_1 >= n_2 >= ... >= n_dim >= low
+
+    :param low:
+    :param high:
+    :param dim:
+    :return: (n_tuples, dim) int64 array
+    """
+    if high < low:
+        return np.zeros((0, dim), dtype=np.int64)
+    if dim == 1:
+        return np.arange(high, low-1, -1, dtype=np.int64)[:, np.newaxis]
+    if dim == 2:
+        i, j = np.tril_indices(high-low+1)
+        return np.stack([high-j, high-i], axis=-1).astype(np.int64)
+    tuples = []
+    for first in range(high, low-1, -1):
+        rest = _descending_tuples(low, first, dim-1)
+        tuples.append(np.concatenate(
+            [np.full((len(rest), 1), first, dtype=np.int64), rest],
+            axis=-1,
+        ))
+    return np.concatenate(tuples, axis=0)
+
+
+def _count_permutations(indices: np.ndarray):
+    """
+    number of distinct permutations of each sorted row, i.e.
+    dim!/prod(multiplicity of each value)!
+
+    :param indices: (n_points, dim) array sorted along the last axis
+    :return:
+    """
+    dim = indices.shape[-1]
+    numerator = float(np.prod(np.arange(1, dim+1)))
+    denominator = np.ones(len(indices))
+    run = np.ones(len(indices))
+    for k in range(1, dim):
+        run = np.where(indices[:, k] == indices[:, k-1], run+1, 1)
+        denominator *= run
+    return numerator/denominator
+
+
+def iter_wedge_blocks(
+    value_range: int,
+    dim: int,
+    symmetry: str,
+):
+    """
+    walk over the irreducible wedge of [-value_range, value_range]^dim
+    under a group of index operations that leaves the cube invariant.
+    The origin is its own orbit and is left out.
+
+    symmetry='cubic': all permutations and sign changes of (n_1, ..., n_d),
+        48 operations in 3D, wedge n_1 >= ... >= n_d >= 0
+    symmetry='permutation_inversion': all permutations combined with
+        n -> -n, 12 operations in 3D and 4 in 2D,
+        wedge n_1 >= ... >= n_d and n >= -reversed(n) lexicographically
+
+    Each block is one value of n_1, i.e. O(value_range^(dim-1)) points.
+
+    :param value_range:
+    :param dim:
+    :param symmetry: 'cubic' or 'permutation_inversion'
+    :return: generator of (indices, multiplicity) tuples
+    """
+    low = _get_wedge_low(value_range, symmetry)
+    for first in range(value_range, low-1, -1):
+        yield get_wedge_block(first, value_range, dim, symmetry)
+
+
+def _get_wedge_low(value_range: int, symmetry: str):
+    if symmetry == 'cubic':
+        return 0
+    if symmetry == 'permutation_inversion':
+        return -value_range
+    raise NotImplementedError(symmetry)
+
+
+def get_wedge_block(
+    first: int,
+    value_range: int,
+    dim: int,
+    symmetry: str,
+):
+    """
+    the points of the irreducible wedge with n_1 = first,
+    see iter_wedge_blocks
+
+    :param first:
+    :param value_range:
+    :param dim:
+    :param symmetry: 'cubic' or 'permutation_inversion'
+    :return: (indices, multiplicity)
+    """
+    low = _get_wedge_low(value_range, symmetry)
+    rest = _descending_tuples(low, first, dim-1)
+    indices = np.concatenate(
+        [np.full((len(rest), 1), first, dtype=np.int64), rest],
+        axis=-1,
+    )
+    multiplicity = _count_permutations(indices)
+    if symmetry == 'cubic':
+        multiplicity *= 2.0**np.count_nonzero(indices, axis=-1)
+    else:
+        # keep the lexicographically larger of n and -reversed(n)
+        diff = indices + indices[:, ::-1]
+        first_diff = diff[
+            np.arange(len(diff)),
+            np.argmax(diff != 0, axis=-1),
+        ]
+        indices = indices[first_diff >= 0]
+        multiplicity = multiplicity[first_diff >= 0]
+        self_inverse = first_diff[first_diff >= 0] == 0
+        multiplicity *= np.where(self_inverse, 1.0, 2.0)
+    nonzero = np.any(indices != 0, axis=-1)
+    return indices[nonzero], multiplicity[nonzero]
+
+
+def _sum_wedge_block(
+    first: int,
+    term_func,
+    value_range: int,
+    dim: int,
+    symmetry: str,
+    reduction='pairwise',
+    with_error=False,
+):
+    return sum_block(
+        term_func,
+        get_wedge_block(first, value_range, dim, symmetry),
+        reduction,
+        with_error,
+    )
+
+
+def sum_lattice_symmetric(
+    term_func,
+    value_range: int,
+    dim: int,
+    symmetry: str,
+    workers=1,
+    reduction='pairwise',
+    return_error=False,
+):
+    """
+    sum term_func over [-value_range, value_range]^dim, origin excluded,
+    visiting only the irreducible wedge and weighting each point by the
+    size of its orbit. term_func must be invariant under the group and
+    return exactly one term per index.
+
+    :param term_func: maps an (n_points, dim) index array to terms
+    :param value_range:
+    :param dim:
+    :param symmetry: see iter_wedge_blocks
+    :param workers: number of processes, None for all cores
+    :param reduction: 'pairwise', 'compensated' or 'exact',
+        see reduce_terms
+    :param return_error: also return the bound of the rounding error
+    :return: sum[, error]
+    """
+    low = _get_wedge_low(value_range, symmetry)
+    return merge_partial_sums(
+        map_blocks(
+            func=partial(
+                _sum_wedge_block,
+                term_func=term_func,
+                value_range=value_range,
+                dim=dim,
+                symmetry=symmetry,
+                reduction=reduction,
+                with_error=return_error,
+            ),
+            items=range(value_range, low-1, -1),
+            workers=workers,
+        ),
+        reduction=reduction,
+        return_error=return_error,
+    )
+
+
+def get_min_plane_spacing(lattice: np.ndarray):
+    """
+    smallest distance between neighbouring lattice planes, i.e. the
+    radius of the sphere inscribed in the cell [-1, 1]^dim @ lattice
+
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :return:
+    """
+    return 1.0/np.max(np.linalg.norm(np.linalg.inv(lattice), axis=0))
+
+
+def _get_shell_points(prefixes, gram, r_low, r_high):
+    """
+    the points n with r_low <= |n @ lattice| < r_high whose first dim-1
+    indices are a row of prefixes. Along the last axis
+    |r|^2 = a*(n_d - center)^2 + r_sq_min, so every prefix contributes
+    the integers between the two spheres on either side of center
+
+    :param prefixes: (n_prefixes, dim-1) int64 array
+    :param gram: lattice @ lattice.T
+    :param r_low:
+    :param r_high:
+    :return: (n_points, dim) int64 array
+    """
+    a = gram[-1, -1]
+    b = prefixes@gram[:-1, -1]
+    center = -b/a
+    r_sq_min = np.einsum(
+        'ij,jk,ik->i', prefixes, gram[:-1, :-1], prefixes,
+    ) - b*b/a
+    reach = r_sq_min < r_high**2
+    prefixes, center, r_sq_min = prefixes[reach], center[reach], \
+        r_sq_min[reach]
+    half_high = np.sqrt((r_high**2 - r_sq_min)/a)
+    half_low = np.sqrt(np.maximum(r_low**2 - r_sq_min, 0.0)/a)
+    # the candidates reach a little over both spheres against rounding,
+    # the exact r_sq below decides, the same for every shell
+    margin = 1e-9*(1 + half_high + np.abs(center))
+    low = np.ceil(center - half_high - margin).astype(np.int64)
+    high = np.floor(center + half_high + margin).astype(np.int64)
+    inner_low = np.floor(center - half_low + margin).astype(np.int64) + 1
+    inner_high = np.ceil(center + half_low - margin).astype(np.int64) - 1
+    hollow = inner_low <= inner_high
+
+    starts = np.concatenate([low, np.maximum(low, inner_high+1)[hollow]])
+    stops = np.concatenate([
+        np.where(hollow, np.minimum(high, inner_low-1), high),
+        high[hollow],
+    ])
+    rows = np.concatenate([
+        np.arange(len(prefixes)), np.flatnonzero(hollow),
+    ])
+    counts = np.maximum(stops - starts + 1, 0)
+    rows = np.repeat(rows, counts)
+    last = np.repeat(starts - np.cumsum(counts) + counts, counts) \
+        + np.arange(len(rows))
+    distance = last - center[rows]
+    r_sq = a*distance*distance + r_sq_min[rows]
+    inside = (r_sq >= r_low**2) & (r_sq < r_high**2)
+    rows = rows[inside]
+    indices = np.empty((len(rows), gram.shape[0]), dtype=np.int64)
+    indices[:, :-1] = prefixes[rows]
+    indices[:, -1] = last[inside]
+    return indices
+
+
+def iter_shell_blocks(
+    lattice: np.ndarray,
+    step: int,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    walk over the lattice points with
+    step*h_min <= |n @ lattice| < (step+1)*h_min, h_min being the
+    smallest distance between lattice planes. The last index is solved
+    for from the others, so only the prefixes of the bounding box of the
+    shell and the shell itself are held in memory, never the ball.
+
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :param step: number of the shell
+    :param block_size: about the number of points per block
+    :return: generator of (n_points, dim) int64 arrays
+    """
+    dim = len(lattice)
+    h_min = get_min_plane_spacing(lattice)
+    gram = lattice@lattice.T
+    # |n_i| <= |r|*|column i of lattice^-1|
+    bounds = np.floor(
+        (step+1)*h_min*np.linalg.norm(np.linalg.inv(lattice), axis=0)
+    ).astype(np.int64)
+    box = [np.arange(-k, k+1, dtype=np.int64) for k in bounds[:-1]]
+    num_prefixes = int(np.prod([len(axis) for axis in box]))
+    # a few points per prefix
+    chunk = max(block_size//4, 1)
+    for start in range(0, num_prefixes, chunk):
+        if dim == 1:
+            prefixes = np.zeros((1, 0), dtype=np.int64)
+        else:
+            prefixes = get_box_block(
+                box, start, min(start+chunk, num_prefixes),
+            )
+        indices = _get_shell_points(
+            prefixes, gram, step*h_min, (step+1)*h_min,
+        )
+        if len(indices) > 0:
+            yield indices
+
+
+def sum_lattice_shells(
+    term_func,
+    lattice: np.ndarray,
+    tol: float,
+    power,
+    weight=1.0,
+    max_range=DEFAULT_MAX_RANGE,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    sum term_func shell by shell with increasing |r| until the tail
+    outside the summed ball, estimated by calc_tail_correction, is below
+    tol relative to the total. Memory is O(block_size + shell). Once the
+    tail shows that tol needs more than the points within max_range,
+    RuntimeError is raised without summing them.
+
+    :param term_func: maps an (n_points, dim) index array to terms
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :param tol: relative tolerance
+    :param power: float or array, |terms| <= weight/(r^2)^power,
+        needs 2*power > dim
+    :param weight: float or array broadcasting against power
+    :param max_range: largest shell, in units of the smallest distance
+        between lattice planes
+    :param block_size: about the number of points evaluated at once
+    :return:
+    """
+    dim = len(lattice)
+    power = np.asarray(power, dtype=float)
+    if np.any(2*power <= dim):
+        raise ValueError('tol needs 2*power > dim, the sum diverges')
+    ball = np.pi**(dim/2)/gamma_function(dim/2+1)
+    max_cells = ball*((max_range+1)*get_min_plane_spacing(lattice))**dim \
+        / abs(np.linalg.det(lattice))
+
+    total = 0.0
+    compensation = 0.0
+    num_cells = 0
+    for step in range(max_range+1):
+        for indices in iter_shell_blocks(lattice, step, block_size):
+            num_cells += len(indices)
+            total, compensation = add_compensated(
+                total, compensation, np.sum(term_func(indices), axis=-1),
+            )
+        if num_cells <= 1:
+            # only the origin
+            continue
+        result = total + compensation
+        tail = np.abs(calc_tail_correction(lattice, power, num_cells, weight))
+        if np.all(tail <= tol*np.abs(result)):
+            if np.ndim(result) == 0:
+                result = float(result)
+            return result
+        # the tail falls as num_cells^(1 - 2*power/dim) and the total
+        # grows at most by it
+        with np.errstate(divide='ignore'):
+            num_needed = num_cells*np.max(
+                (tail/(tol*(np.abs(result) + tail)))**(dim/(2*power-dim))
+            )
+        if num_needed > max_cells:
+            raise RuntimeError(
+                'lattice sum needs about {:.3g} points to reach tol={}, '
+                'more than the {:.3g} within max_range={}'.format(
+                    num_needed, tol, max_cells, max_range,
+                )
+            )
+    raise RuntimeError(
+        'lattice sum not converged to tol={} within max_range={}'.format(
+            tol, max_range,
+        )
+    )
+
+
+def _sum_sphere_range(
+    start: int,
+    term_func,
+    lattice: np.ndarray,
+    value_range: int,
+    cutoff: float,
+    shift,
+    block_size: int,
+):
+    dim = len(lattice)
+    num_points = (2*value_range + 1)**dim
+    indices = get_index_block(
+        start=start,
+        stop=min(start+block_size, num_points),
+        value_range=value_range,
+        dim=dim,
+    )
+    inside = calc_r_sq(indices, lattice, shift) <= cutoff**2
+    return sum_block(term_func, indices[inside]), np.count_nonzero(inside)
+
+
+def sum_lattice_sphere(
+    term_func,
+    lattice: np.ndarray,
+    cutoff: float,
+    shift=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+):
+    """
+    sum term_func over the lattice points with |n @ lattice + shift|
+    <= cutoff
+
+    :param term_func: maps an (n_points, dim) index array to terms
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :param cutoff: radius of the sphere
+    :param shift: Cartesian shift of the sublattice
+    :param block_size:
+    :param workers: number of processes, None for all cores
+    :return: sum, number of lattice points in the sphere
+    """
+    dim = len(lattice)
+    value_range = int(np.ceil(cutoff/get_min_plane_spacing(lattice)))
+    num_points = (2*value_range + 1)**dim
+    partials = list(map_blocks(
+        func=partial(
+            _sum_sphere_range,
+            term_func=term_func,
+            lattice=lattice,
+            value_range=value_range,
+            cutoff=cutoff,
+            shift=shift,
+            block_size=block_size,
+        ),
+        items=range(0, num_points, block_size),
+        workers=workers,
+    ))
+    result = merge_partial_sums(value for value, _ in partials)
+    num_cells = sum(int(count) for _, count in partials)
+    return result, num_cells
+
+
+def calc_tail_correction(
+    lattice: np.ndarray,
+    power,
+    num_cells: int,
+    weight=1.0,
+):
+    """
+    continuum estimate of sum weight/(r^2)^power over the lattice points
+    outside a sphere, rho*int_R^inf r^(-2*power) S_d r^(d-1) dr.
+    R is the radius whose ball has the volume of the num_cells summed
+    cells, which cancels most of the lattice point counting error
+
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :param power: float or array, needs 2*power > dim
+    :param num_cells: number of lattice points inside the sphere
+    :param weight: total weight per cell, e.g. number of sublattices
+    :return:
+    """
+    dim = len(lattice)
+    volume = abs(np.linalg.det(lattice))
+    power = np.asarray(power, dtype=float)
+    # volume of the unit ball and area of the unit sphere
+    ball = np.pi**(dim/2)/gamma_function(dim/2+1)
+    radius = (num_cells*volume/ball)**(1/dim)
+    result = weight*dim*ball*radius**(dim-2*power)/(2*power-dim)/volume
+    if np.ndim(result) == 0:
+        result = float(result)
+    return result
+
+
+def richardson_extrapolate(
+    values,
+    cutoffs,
+    exponent,
+    step=2,
+):
+    """
+    limit of S(N) = S + sum_j c_j*N^-(exponent + step*j) from the values at
+    a few cutoffs N, one error term per extra cutoff
+
+    :param values: (n_cutoffs, ...) array
+    :param cutoffs: (n_cutoffs, )
+    :param exponent: leading exponent of the error, broadcast against
+        values[0]
+    :param step: spacing of the exponents of the higher order terms
+    :return: array of shape values[0].shape
+    """
+    values = np.asarray(values, dtype=float)
+    cutoffs = np.asarray(cutoffs, dtype=float)
+    exponent = np.broadcast_to(exponent, values.shape[1:])
+    result = np.zeros(values.shape[1:])
+    for index in np.ndindex(*values.shape[1:]):
+        matrix = np.stack(
+            [np.ones_like(cutoffs)] + [
+                cutoffs**-(exponent[index] + step*j)
+                for j in range(len(cutoffs)-1)
+            ],
+            axis=-1,
+        )
+        column = values[(slice(None), ) + index]
+        result[index] = np.linalg.solve(matrix, column)[0]
+    if np.ndim(result) == 0:
+        result = float(result)
+    return result
+
+
+def sum_lattice_richardson(
+    term_func,
+    value_range: int,
+    dim: int,
+    exponent,
+    num_levels=4,
+    symmetry=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+):
+    """
+    Richardson extrapolation of the cube sums at the cutoffs
+    value_range*(k+1)/(num_levels+1), k = 1..num_levels. The truncation
+    error of a cube of half width N+1/2 scales exactly with the cube, so
+    it is a series in (N+1/2)^-exponent with even steps
+
+    :param term_func: maps an (n_points, dim) index array to terms
+    :param value_range: largest cutoff
+    :param dim:
+    :param exponent: 2*power - dim for terms like 1/r^(2*power)
+    :param num_levels: number of cutoffs
+    :param symmetry: if given, sum the irreducible wedge,
+        see iter_wedge_blocks
+    :param block_size:
+    :param workers: number of processes, None for all cores
+    :return:
+    """
+    cutoffs = [
+        int(round(value_range*(k+1)/(num_levels+1)))
+        for k in range(1, num_levels+1)
+    ]
+    values = []
+    for cutoff in cutoffs:
+        if symmetry is None:
+            values.append(sum_lattice(
+                term_func, cutoff, dim, block_size, workers=workers,
+            ))
+        else:
+            values.append(sum_lattice_symmetric(
+                term_func, cutoff, dim, symmetry, workers=workers,
+            ))
+    return richardson_extrapolate(
+        values=values,
+        cutoffs=np.array(cutoffs)+0.5,
+        exponent=exponent,
+    )
+
+
+def sum_lattice_extrapolated(
+    term_func,
+    lattice: np.ndarray,
+    value_range: int,
+    power,
+    method='richardson',
+    weight=1.0,
+    shift=None,
+    symmetry=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+):
+    """
+    truncated sum of terms decaying like weight/r^(2*power) with the
+    missing tail accounted for
+
+    :param term_func: maps an (n_points, dim) index array to terms
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :param value_range: half width of the largest summed cube of indices
+    :param power: float or array, the terms decay like 1/r^(2*power)
+    :param method: 'tail' adds the continuum tail to the sum over the
+        sphere inscribed in the cube, 'richardson' extrapolates the cube
+        sums, see sum_lattice_richardson
+    :param weight: total weight per cell, only used by 'tail'
+    :param shift: Cartesian shift of the sublattice, centres the sphere
+        of 'tail' on the reference site
+    :param symmetry: only used by 'richardson', see iter_wedge_blocks
+    :param block_size:
+    :param workers: number of processes, None for all cores
+    :return:
+    """
+    dim = len(lattice)
+    if method == 'tail':
+        result, num_cells = sum_lattice_sphere(
+            term_func=term_func,
+            lattice=lattice,
+            cutoff=value_range*get_min_plane_spacing(lattice),
+            shift=shift,
+            block_size=block_size,
+            workers=workers,
+        )
+        return result + calc_tail_correction(
+            lattice=lattice,
+            power=power,
+            num_cells=num_cells,
+            weight=weight,
+        )
+    if method == 'richardson':
+        return sum_lattice_richardson(
+            term_func=term_func,
+            value_range=value_range,
+            dim=dim,
+            exponent=2*np.asarray(power, dtype=float) - dim,
+            symmetry=symmetry,
+            block_size=block_size,
+            workers=workers,
+        )
+    raise ValueError('unknown extrapolation method {}'.format(method))
+
+
+def calc_r_sq(
+    indices: np.ndarray,
+    lattice: np.ndarray,
+    shift=None,
+):
+    """
+    squared length of n @ lattice + shift
+
+    :param indices: (n_points, dim) integer array
+    :param lattice: (dim, dim) array, lattice vectors as rows
+    :param shift: Cartesian shift of the sublattice
+    :return:
+    """
+    # column by column, several times faster than indices@lattice and a
+    # reduction along the short last axis
+    columns = [indices[:, k].astype(float) for k in range(indices.shape[-1])]
+    r_sq = 0.0
+    for j in range(lattice.shape[-1]):
+        r_j = columns[0]*lattice[0, j]
+        for k in range(1, len(columns)):
+            r_j += columns[k]*lattice[k, j]
+        if shift is not None:
+            r_j += shift[j]
+        r_sq = r_sq + r_j*r_j
+    return r_sq
+
+
+def calc_inverse_power(r_sq, power, dtype=np.float64, numerator=1.0):
+    """
+    numerator/(r^2)^power. With dtype=np.float32 the terms are evaluated
+    as numerator*(1/r^2)^power in single precision from 1/r^2 in double
+    precision. That pays off where the term arrays are much larger than
+    the index block, e.g. term_rhombus over many angles and powers, see
+    calc_single_precision_bound for the accuracy. The block reductions
+    always accumulate in double precision.
+
+    :param r_sq: float64 array
+    :param power: float or array broadcasting against r_sq
+    :param dtype: np.float64 or np.float32
+    :param numerator: float or array broadcasting against r_sq
+    :return:
+    """
+    if dtype == np.float64:
+        return numerator/np.power(r_sq, power)
+    inverse = (1.0/r_sq).astype(dtype)
+    power = np.asarray(power, dtype=dtype)
+    # terms below the smallest normal number are flushed to zero before
+    # the power, subnormal results make it an order of magnitude slower
+    normal = inverse >= np.finfo(dtype).tiny**(1/power)
+    result = np.zeros(np.broadcast_shapes(inverse.shape, power.shape), dtype)
+    np.power(inverse, power, out=result, where=normal)
+    if np.any(numerator != 1.0):
+        result = result*np.asarray(numerator, dtype=dtype)
+    return result
+
+
+def calc_single_precision_bound(power, abs_sum, num_terms):
+    """
+    bound of the difference between the sums of calc_inverse_power
+    terms in single and in double precision. Each term is off by at most
+    (power+2)*2^-24 relative (checked for power 0.5 to 8), and terms
+    below the smallest normal float32 are flushed to zero
+
+    :param power: float or array
+    :param abs_sum: sum|t|, float or array broadcasting against power
+    :param num_terms:
+    :return:
+    """
+    single = np.finfo(np.float32)
+    # unit roundoff of float32
+    return (np.asarray(power, dtype=float) + 2)*float(single.eps/2)*abs_sum \
+        + float(single.tiny)*num_terms
+
+
+def term_inverse_power(
+    indices: np.ndarray,
+    lattice: np.ndarray,
+    power: float,
+    shift=None,
+):
+    """
+    1/(r^2)^power, points at r = 0 are left out.
+    For an array of powers r^2 is computed once and one row of terms
+    is returned per power
+
+    :param indices:
+    :param lattice:
+    :param power: float or (n_powers, ) array
+    :param shift:
+    :return: (n_points, ) or (n_powers, n_points) array
+    """
+    r_sq = calc_r_sq(indices, lattice, shift)
+    r_sq = r_sq[r_sq.nonzero()]
+    power = np.reshape(power, np.shape(power)+(1, ))
+    return 1.0/np.power(r_sq, power)
+
+
+def term_sublattices(
+    indices: np.ndarray,
+    lattice: np.ndarray,
+    power: float,
+    shifts: np.ndarray,
+    weights: np.ndarray,
+):
+    """
+    sum over sublattices of weight/(r^2)^power, points at r = 0 are
+    left out. power=0.5 with charges as weights gives the Madelung sum
+
+    :param indices:
+    :param lattice:
+    :param power: float or (n_powers, ) array
+    :param shifts: (n_sites, dim) Cartesian positions of the sublattices
+    :param weights: (n_sites, )
+    :return: (n_points, ) or (n_powers, n_points) array
+    """
+    result = np.zeros(np.shape(power)+(len(indices), ))
+    power = np.reshape(power, np.shape(power)+(1, ))
+    for shift, weight in zip(shifts, weights):
+        r_sq = calc_r_sq(indices, lattice, shift)
+        nonzero = r_sq != 0.0
+        result[..., nonzero] += weight/np.power(r_sq[nonzero], power)
+    return result
+
+
+def term_alternating(
+    indices: np.ndarray,
+    lattice: np.ndarray,
+    power: float,
+):
+    """
+    (-1)^(n_1+...+n_dim)/(r^2)^power, e.g. the rock-salt charges on a
+    simple lattice. The sign comes from the integer parity of the
+    indices and the origin is dropped before dividing, so no inf is
+    ever produced.
+
+    :param indices: (n_points, dim) integer array
+    :param lattice:
+    :param power: float or (n_powers, ) array
+    :return: (n_points-1, ) or (n_powers, n_points-1) array if the
+        origin is in indices
+    """
+    # summing the columns is much faster than a reduction along axis -1
+    parity = indices[:, 0] & 1
+    for k in range(1, indices.shape[-1]):
+        parity ^= indices[:, k] & 1
+    r_sq = calc_r_sq(indices, lattice)
+    nonzero = r_sq.nonzero()
+    sign = 1.0 - 2.0*parity[nonzero]
+    power = np.reshape(power, np.shape(power)+(1, ))
+    return sign/np.power(r_sq[nonzero], power)
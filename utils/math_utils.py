@@ -1,5 +1,6 @@
 import numpy as np
 import itertools
+from scipy.optimize import brentq
 from sympy import MatrixSymbol, Matrix
 
 
@@ -34,3 +35,51 @@ def tensor_transformation(matrix_a):
         #             print('+{}X[{},{}]'.format(c,m,n), end=' ')
         # print()
     return s_2
+
+
+def find_roots_bracketed(func, x_grid, xtol=1e-10):
+    """
+    all roots of func on the range of x_grid. func is evaluated once on
+    the whole coarse grid (it may be vectorized), then every sign change
+    is refined with Brent's method
+
+    :param func: f(x), called with the array x_grid and with floats
+    :param x_grid: sorted coarse grid, fine enough to separate the roots
+    :param xtol: absolute tolerance of the roots
+    :return: sorted array of roots
+    """
+    x_grid = np.asarray(x_grid, dtype=float)
+    y_grid = np.asarray(func(x_grid), dtype=float)
+
+    roots = list(x_grid[y_grid == 0.0])
+    brackets = np.nonzero(y_grid[:-1]*y_grid[1:] < 0.0)[0]
+    for i in brackets:
+        roots.append(brentq(
+            func,
+            x_grid[i],
+            x_grid[i+1],
+            xtol=xtol,
+        ))
+    return np.sort(np.array(roots))
+
+
+def bisect_elementwise(func, low, high, xtol, sign_low):
+    """
+    elementwise bisection of func on [low, high]
+
+    :param func: vectorized
+    :param low: array
+    :param high: array of the same shape
+    :param xtol: absolute tolerance
+    :param sign_low: +-1, sign of func at low and -sign at high. Given
+        rather than evaluated, so that roots at low are found as well
+    :return: array of roots
+    """
+    width = np.nanmax(high - low, initial=0.0)
+    num_iterations = int(np.ceil(np.log2(max(width/xtol, 1.0))))
+    for _ in range(min(num_iterations, 1100)):
+        middle = (low + high)/2
+        same = np.sign(func(middle)) == sign_low
+        low = np.where(same, middle, low)
+        high = np.where(same, high, middle)
+    return (low + high)/2
@@ -0,0 +1,219 @@
+import numpy as np
+from scipy.linalg import eigh_tridiagonal
+from scipy.sparse import diags
+from scipy.sparse.linalg import eigsh
+
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# Wolfsberg-Helmholz constant of the extended Hueckel method
+HUECKEL_K = 1.75
+
+
+def calc_exponential_orbital(x, scale=1., shift=0.):
+    """
+    normalized 1D orbital sqrt(scale)*exp(-scale*|x - shift|),
+    broadcasting over all arguments
+
+    :param x:
+    :param scale: inverse decay length
+    :param shift: position of the site
+    :return:
+    """
+    scale = np.asarray(scale, dtype=float)
+    return np.sqrt(scale)*np.exp(-np.abs(scale*(x - shift)))
+
+
+def calc_exponential_overlap(distance, scale_1, scale_2):
+    """
+    <phi_1|phi_2> of two calc_exponential_orbital a distance apart,
+    broadcasting over all arguments
+
+    :param distance:
+    :param scale_1:
+    :param scale_2:
+    :return: 1 for the same orbital on the same site
+    """
+    d, k_1, k_2 = np.broadcast_arrays(*(
+        np.asarray(x, dtype=float)
+        for x in (np.abs(distance), scale_1, scale_2)
+    ))
+    e_1 = np.exp(-k_1*d)
+    e_2 = np.exp(-k_2*d)
+    difference = k_2 - k_1
+    same = np.abs(difference) <= 1e-8*(k_1 + k_2)
+    # (e_1 - e_2)/(k_2 - k_1) tends to d*e_1 for k_2 -> k_1
+    middle = np.where(
+        same,
+        d*np.sqrt(e_1*e_2),
+        (e_1 - e_2)/np.where(same, 1.0, difference),
+    )
+    return np.sqrt(k_1*k_2)*((e_1 + e_2)/(k_1 + k_2) + middle)
+
+
+def build_chain_matrices(onsite, hopping, overlap=0.0, periodic=False):
+    """
+    H and S of a chain with nearest neighbour coupling, for every
+    parameter set of the leading axes at once
+
+    :param onsite: (..., N) site energies
+    :param hopping: (..., N-1) couplings of the sites i and i+1, or
+        (..., N) with the last one coupling N-1 and 0 if periodic,
+        or anything broadcasting against those
+    :param overlap: like hopping, 0 for orthogonal orbitals
+    :param periodic: couple the last site to the first
+    :return: H and S, (..., N, N)
+    """
+    onsite = np.asarray(onsite, dtype=float)
+    num_sites = onsite.shape[-1]
+    num_bonds = num_sites if periodic else num_sites - 1
+    bond_shape = onsite.shape[:-1] + (num_bonds, )
+    hopping = np.broadcast_to(np.asarray(hopping, dtype=float), bond_shape)
+    overlap = np.broadcast_to(np.asarray(overlap, dtype=float), bond_shape)
+    i = np.arange(num_bonds)
+    j = (i + 1) % num_sites
+
+    matrices = []
+    for diagonal, bonds in ((onsite, hopping), (1.0, overlap)):
+        matrix = np.zeros(bond_shape[:-1] + (num_sites, num_sites))
+        matrix[..., np.arange(num_sites), np.arange(num_sites)] = diagonal
+        # += so that a periodic chain of 2 sites gets both bonds
+        np.add.at(matrix, (..., i, j), bonds)
+        np.add.at(matrix, (..., j, i), bonds)
+        matrices.append(matrix)
+    return tuple(matrices)
+
+
+def build_lcao_matrices(positions, scales, onsite, K=HUECKEL_K):
+    """
+    H and S of calc_exponential_orbital on N sites by the extended
+    Hueckel method, S from the analytic overlaps and
+    H_ij = K*S_ij*(H_ii + H_jj)/2, for every parameter set of the
+    leading axes at once
+
+    :param positions: (..., N)
+    :param scales: (..., N) inverse decay lengths of the orbitals
+    :param onsite: (..., N) orbital energies H_ii
+    :param K: Wolfsberg-Helmholz constant
+    :return: H and S, (..., N, N)
+    """
+    positions, scales, onsite = np.broadcast_arrays(*(
+        np.asarray(x, dtype=float) for x in (positions, scales, onsite)
+    ))
+    S = calc_exponential_overlap(
+        positions[..., :, None] - positions[..., None, :],
+        scales[..., :, None],
+        scales[..., None, :],
+    )
+    H = K*S*(onsite[..., :, None] + onsite[..., None, :])/2
+    diagonal = np.arange(positions.shape[-1])
+    H[..., diagonal, diagonal] = onsite
+    S[..., diagonal, diagonal] = 1.0
+    return H, S
+
+
+def solve_lcao(H, S=None):
+    """
+    H c = E S c for every matrix of the leading axes at once with
+    np.linalg.eigh. A non-orthogonal basis is orthogonalized by the
+    Cholesky factor S = L L^T.
+
+    :param H: (..., N, N) symmetric
+    :param S: (..., N, N) symmetric positive definite, the identity if
+        None
+    :return: energies (..., N) increasing, and coefficients
+        (..., N, N) with the molecular orbital of energies[..., n] in
+        the column n, normalized as c^T S c = 1
+    """
+    H = np.asarray(H, dtype=float)
+    if S is None:
+        return np.linalg.eigh(H)
+    L_inv = np.linalg.inv(np.linalg.cholesky(np.asarray(S, dtype=float)))
+    L_inv_T = np.swapaxes(L_inv, -1, -2)
+    energies, coefficients = np.linalg.eigh(L_inv @ H @ L_inv_T)
+    return energies, L_inv_T @ coefficients
+
+
+def solve_chain(
+    onsite,
+    hopping,
+    overlap=0.0,
+    num_states=None,
+    sigma=None,
+    eigvals_only=False,
+):
+    """
+    eigenstates of one long open chain without building dense matrices.
+    Orthogonal orbitals use the tridiagonal solver of LAPACK for all
+    or the lowest num_states states. With an overlap the generalized
+    problem goes to the sparse Lanczos solver for num_states states,
+    in shift-invert mode around sigma if given. Without sigma it looks
+    for the lowest states directly, which converges slowly for long
+    chains, whose band bottom is tightly clustered.
+
+    :param onsite: (N, ) site energies
+    :param hopping: (N-1, ) or float, couplings of the sites i and i+1
+    :param overlap: (N-1, ) or float, overlaps of the sites i and i+1
+    :param num_states: all if None, required with an overlap
+    :param sigma: energy near the wanted states
+    :param eigvals_only: skip the (N, num_states) coefficients, e.g.
+        for all states of 10^4 sites
+    :return: energies (num_states, ) increasing, and unless
+        eigvals_only coefficients (N, num_states) normalized as
+        c^T S c = 1
+    """
+    onsite = np.asarray(onsite, dtype=float)
+    num_sites = len(onsite)
+    hopping = np.broadcast_to(
+        np.asarray(hopping, dtype=float), (num_sites - 1, ),
+    )
+    overlap = np.broadcast_to(
+        np.asarray(overlap, dtype=float), (num_sites - 1, ),
+    )
+    if not overlap.any():
+        select = dict()
+        if num_states is not None:
+            select = dict(select='i', select_range=(0, num_states - 1))
+        return eigh_tridiagonal(
+            onsite, hopping, eigvals_only=eigvals_only, **select,
+        )
+
+    if num_states is None:
+        raise ValueError('num_states is required with an overlap')
+    H = diags([hopping, onsite, hopping], [-1, 0, 1], format='csc')
+    S = diags([overlap, np.ones(num_sites), overlap], [-1, 0, 1],
+              format='csc')
+    mode = dict(which='SA') if sigma is None else dict(sigma=sigma)
+    result = eigsh(
+        H, k=num_states, M=S, return_eigenvectors=not eigvals_only, **mode,
+    )
+    if eigvals_only:
+        return np.sort(result)
+    energies, coefficients = result
+    order = np.argsort(energies)
+    return energies[order], coefficients[:, order]
+
+
+def evaluate_orbitals(x, coefficients, positions, scales):
+    """
+    molecular orbitals sum_j c_jn*phi_j(x) of calc_exponential_orbital
+    on a grid, e.g. for plotting
+
+    :param x: (n_x, ) grid
+    :param coefficients: (..., N, n_orbitals) as from solve_lcao
+    :param positions: (..., N)
+    :param scales: (..., N)
+    :return: (..., n_orbitals, n_x)
+    """
+    positions, scales = np.broadcast_arrays(
+        np.asarray(positions, dtype=float), np.asarray(scales, dtype=float),
+    )
+    atomic = calc_exponential_orbital(
+        np.asarray(x, dtype=float),
+        scales[..., None],
+        positions[..., None],
+    )
+    return np.swapaxes(coefficients, -1, -2) @ atomic